@@ -98,7 +98,7 @@ class ACOptionAgent():
       sess.run(self.update_local_vars)
 
       for idx in range(self.config.input_size[0] * self.config.input_size[1]):
-        s, i, j = self.env.get_state(idx)
+        s, i, j = self.env.fake_get_state(idx)
 
         # if not self.env.not_wall(i, j):
         #   plt.gca().add_patch(
@@ -187,7 +187,7 @@ class ACOptionAgent():
       sess.run(self.update_local_vars)
 
       for idx in range(self.config.input_size[0] * self.config.input_size[1]):
-        s, i, j = self.env.get_state(idx)
+        s, i, j = self.env.fake_get_state(idx)
         if not self.env.not_wall(i, j):
           plt.gca().add_patch(
             patches.Rectangle(
@@ -260,7 +260,7 @@ class ACOptionAgent():
       sess.run(self.update_local_vars)
 
       for idx in range(self.config.input_size[0] * self.config.input_size[1]):
-        s, i, j = self.env.get_state(idx)
+        s, i, j = self.env.fake_get_state(idx)
         if not self.env.not_wall(i, j):
           plt.gca().add_patch(
             patches.Rectangle(
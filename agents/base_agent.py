@@ -1,7 +1,10 @@
 import numpy as np
 import tensorflow as tf
-from tools.utils import update_target_graph_aux, update_target_graph_sf, \
-  update_target_graph_option, discount, reward_discount, set_image, make_gif
+from tools.utils import update_local_graph, discount, reward_discount, set_image, make_gif
+from tools.replay_buffer import aux_replay_buffer
+from tools.summary_sink import summary_writer
+from tools.step_counter import StepCounter
+from tools.rollout_buffer import RolloutBuffer
 import os
 
 from tools.ring_buffer import RingBuffer
@@ -15,6 +18,7 @@ import numpy as np
 from matplotlib import cm
 from collections import deque
 from agents.schedules import LinearSchedule, TFLinearSchedule
+from agents.eigenvector_service import solve_directions, directions_summary
 from PIL import Image
 import scipy.stats
 import seaborn as sns
@@ -53,7 +57,6 @@ class BaseAgent():
     self.global_network = global_network
     self.directions = self.global_network.directions
 
-    self.increment_global_step = self.global_step.assign_add(1)
     self.episode_rewards = []
     self.episode_lengths = []
     self.episode_mean_values = []
@@ -68,22 +71,40 @@ class BaseAgent():
     self.episode_actions = []
     self.config = config
     self.total_steps_tensor = tf.Variable(0, dtype=tf.int32, name='total_steps_tensor', trainable=False)
-    self.increment_total_steps_tensor = self.total_steps_tensor.assign_add(1)
+    # Steps and episodes are counted in Python and added to total_steps_tensor and global_step in batches
+    self.step_counter = StepCounter(self.total_steps_tensor, config.steps_sync_interval)
+    self.episode_counter = StepCounter(self.global_step, config.episodes_sync_interval)
+    global_network.step_counters += [self.step_counter, self.episode_counter]
     self.total_steps = 0
     self.action_size = game.action_space.n
     self.nb_options = config.nb_options
     self.nb_states = game.nb_states
-    self.summary_writer = tf.summary.FileWriter(self.summary_path + "/worker_" + str(self.thread_id))
+    self.summary_writer = summary_writer(self.summary_path + "/worker_" + str(self.thread_id), global_network)
 
     self.local_network = config.network(self.name, config, self.action_size, self.nb_states, self.total_steps_tensor)
-
-    self.update_local_vars_aux = update_target_graph_aux('global', self.name)
-    self.update_local_vars_sf = update_target_graph_sf('global', self.name)
-    self.update_local_vars_option = update_target_graph_option('global', self.name)
+    self.episode_buffer_sf = RolloutBuffer(config.max_update_freq, [("observations", None)])
+    self.episode_buffer_option = RolloutBuffer(config.max_update_freq, [
+      ("observations", None), ("options", np.int32), ("actions", np.int32), ("rewards", np.float64),
+      ("eigen_rewards", np.float64), ("primitive_actions", np.bool_)])
+
+    self.update_local_vars = {group: update_local_graph('global', self.name, group)
+                              for group in ("aux", "sf", "option")}
+    # Versions of the global parameters last copied into the local network, per group
+    self.synced_versions = {}
     self.env = game
     self.nb_states = game.nb_states
     # self.init_or_load_SR()
 
+  def sync_local_vars(self, group):
+    """Copies a group of global parameters into the local network, unless no gradient was applied to them since the
+    last copy. Returns whether they were copied."""
+    version = self.global_network.get_param_version(group)
+    if self.synced_versions.get(group) == version:
+      return False
+    self.sess.run(self.update_local_vars[group])
+    self.synced_versions[group] = version
+    return True
+
   def load_directions(self):
     self.directions = self.global_network.directions
 
@@ -100,22 +121,22 @@ class BaseAgent():
       ms_aux = ms_sf = ms_option = None
       tf.logging.info("Starting worker " +
                       str(self.thread_id))
-      self.aux_episode_buffer = deque()
+      self.aux_episode_buffer = aux_replay_buffer(self.config, self.env, self.global_network, self.thread_id)
 
       while not coord.should_stop():
         if self.total_steps > self.config.steps and self.name == "worker_0":
-          return 0
-        sess.run(self.update_local_vars_aux)
-        sess.run(self.update_local_vars_sf)
-        sess.run(self.update_local_vars_option)
+          break
+        self.sync_local_vars("aux")
+        self.sync_local_vars("sf")
+        self.sync_local_vars("option")
 
         if self.name == "worker_0" and self.episode_count > 0:
           self.recompute_eigenvectors_classic()
 
         self.load_directions()
 
-        self.episode_buffer_sf = []
-        self.episode_buffer_option = []
+        self.episode_buffer_sf.clear()
+        self.episode_buffer_option.clear()
         self.episode_values = []
         self.episode_q_values = []
         self.episode_eigen_q_values = []
@@ -136,11 +157,11 @@ class BaseAgent():
         self.option_evaluation(s)
         while not d:
           if self.total_steps % self.config.target_update_iter_aux == 0:
-            sess.run(self.update_local_vars_aux)
+            self.sync_local_vars("aux")
           if self.total_steps % self.config.target_update_iter_sf == 0:
-            sess.run(self.update_local_vars_sf)
+            self.sync_local_vars("sf")
           if self.total_steps % self.config.target_update_iter_option == 0:
-            sess.run(self.update_local_vars_option)
+            self.sync_local_vars("option")
 
           self.policy_evaluation(s)
           s1, r, d, _ = self.env.step(self.action)
@@ -174,7 +195,7 @@ class BaseAgent():
               # if self.name == "worker_0":
               #   tf.logging.info(
               #     "Episode {} >> Step {} >>> SF_loss {}".format(self.episode_count, self.total_steps, sf_loss))
-              self.episode_buffer_sf = []
+              self.episode_buffer_sf.clear()
               t_counter_sf = 0
 
             if self.total_steps > self.config.eigen_exploration_steps:
@@ -224,7 +245,7 @@ class BaseAgent():
                   #     "Episode {} >> Step {} >>> option_loss {}".format(self.episode_count, self.total_steps,
                   #                                                       option_loss))
 
-                self.episode_buffer_option = []
+                self.episode_buffer_option.clear()
                 t_counter_option = 0
 
               if not d and (self.o_term or self.primitive_action):
@@ -239,7 +260,7 @@ class BaseAgent():
           s = s1
           t += 1
           self.total_steps += 1
-          sess.run(self.increment_total_steps_tensor)
+          self.step_counter.add(sess)
 
         if self.name == "worker_0":
           tf.logging.info("Episode {} >> Step {} >> Length: {} >>> Reward: {}".format(self.episode_count,
@@ -281,9 +302,12 @@ class BaseAgent():
           self.write_episode_summary(ms_sf, ms_aux, ms_option, r)
 
         if self.name == 'worker_0':
-          sess.run(self.increment_global_step)
+          self.episode_counter.add(sess)
         self.episode_count += 1
 
+      self.step_counter.sync(sess)
+      self.episode_counter.sync(sess)
+
   def option_evaluation(self, s):
     feed_dict = {self.local_network.observation: np.stack([s])}
     self.option, self.primitive_action = self.sess.run(
@@ -334,10 +358,8 @@ class BaseAgent():
 
   def store_general_info(self, s, s1, a, r):
     if self.config.eigen:
-      self.episode_buffer_sf.append([s, s1, a])
-    if len(self.aux_episode_buffer) == self.config.memory_size:
-      self.aux_episode_buffer.popleft()
-    self.aux_episode_buffer.append([s, s1, a])
+      self.episode_buffer_sf.append(s)
+    self.aux_episode_buffer.append(s, s1, a)
     self.episode_reward += r
 
   def store_option_info(self, s, s1, a, r):
@@ -350,17 +372,17 @@ class BaseAgent():
       # tf.logging.warning("INTRINSIC REWARD is {}".format(eigen_r))
       r_i = self.config.alpha_r * eigen_r + (1 - self.config.alpha_r) * r
       self.episode_eigen_q_values.append(self.eigen_q_value)
-      self.episode_buffer_option.append(
-        [s, self.option, self.action, r, r_i, self.primitive_action])
+      self.episode_buffer_option.append(s, self.option, self.action, r, r_i, self.primitive_action)
     else:
       r_i = r
-      self.episode_buffer_option.append(
-        [s, self.option, self.action, r, r_i, None])
+      self.episode_buffer_option.append(s, self.option, self.action, r, r_i, None)
     self.episode_values.append(self.value)
     self.episode_q_values.append(self.q_value)
     self.episode_oterm.append(self.o_term)
 
   def save_model(self):
+    for counter in self.global_network.step_counters:
+      counter.sync(self.sess)
     self.saver.save(self.sess, self.model_path + '/model-{}.{}.cptk'.format(self.episode_count, self.total_steps),
                     global_step=self.global_step)
     tf.logging.info(
@@ -458,24 +480,13 @@ class BaseAgent():
           feed_dict = {self.local_network.observation: [s]}
           sf = self.sess.run(self.local_network.sf, feed_dict=feed_dict)[0]
           matrix_sf[idx] = sf
-      feed_dict = {self.local_network.matrix_sf: matrix_sf}
-      eigenval, eigenvect = self.sess.run([self.local_network.eigenvalues, self.local_network.eigenvectors],
-                                          feed_dict=feed_dict)
-      # u, s, v = np.linalg.svd(self.sr_matrix_buffer.get(), full_matrices=False)
-      eigenvalues = eigenval[self.config.first_eigenoption:self.config.nb_options + self.config.first_eigenoption]
-      new_eigenvectors = eigenvect[self.config.first_eigenoption:self.config.nb_options + self.config.first_eigenoption]
-      min_similarity = np.min([self.cosine_similarity(a, b) for a, b in zip(self.global_network.directions, new_eigenvectors)])
-      max_similarity = np.max([self.cosine_similarity(a, b) for a, b in zip(self.global_network.directions, new_eigenvectors)])
-      mean_similarity = np.mean([self.cosine_similarity(a, b) for a, b in zip(self.global_network.directions, new_eigenvectors)])
-      self.summary = tf.Summary()
-      self.summary.value.add(tag='Eigenvectors/Min similarity', simple_value=float(min_similarity))
-      self.summary.value.add(tag='Eigenvectors/Max similarity', simple_value=float(max_similarity))
-      self.summary.value.add(tag='Eigenvectors/Mean similarity', simple_value=float(mean_similarity))
+      _, old_directions, _ = self.global_network.get_directions()
+      _, new_eigenvectors, eigen_basis, solver_info = solve_directions(self.global_network, matrix_sf, self.config)
+      self.global_network.publish_directions(new_eigenvectors, eigen_basis)
+      self.load_directions()
+      self.summary = directions_summary(old_directions, new_eigenvectors, solver_info)
       self.summary_writer.add_summary(self.summary, self.episode_count)
       self.summary_writer.flush()
-      # tf.logging.warning("Min cosine similarity between old eigenvectors and recomputed onesis {}".format(min_similarity))
-      self.global_network.directions = new_eigenvectors
-      self.directions = self.global_network.directions
 
 
   def cosine_similarity(self, next_sf, evect):
@@ -487,113 +498,77 @@ class BaseAgent():
     return res
 
   def train_sf(self, bootstrap_sf):
-    rollout = np.array(self.episode_buffer_sf)
-    observations = rollout[:, 0]
+    observations = self.episode_buffer_sf["observations"]
 
-    feed_dict = {self.local_network.observation: np.stack(observations, axis=0)}
+    feed_dict = {self.local_network.observation: observations}
     fi = self.sess.run(self.local_network.fi,
                        feed_dict=feed_dict)
 
-    sf_plus = np.asarray(fi.tolist() + [bootstrap_sf])
+    sf_plus = np.concatenate([fi, [bootstrap_sf]])
     discounted_sf = discount(sf_plus, self.config.discount)[:-1]
 
-    feed_dict = {self.local_network.target_sf: np.stack(discounted_sf, axis=0),
-                 self.local_network.observation: np.stack(observations, axis=0)}  # ,
+    feed_dict = {self.local_network.target_sf: discounted_sf,
+                 self.local_network.observation: observations}
 
     _, ms, sf_loss = \
       self.sess.run([self.local_network.apply_grads_sf,
                      self.local_network.merged_summary_sf,
                      self.local_network.sf_loss],
                     feed_dict=feed_dict)
+    self.global_network.bump_param_versions(self.local_network.updated_groups["sf"])
 
     return ms, sf_loss
 
   def train_aux(self):
-    minibatch = random.sample(self.aux_episode_buffer, self.config.batch_size)
-    rollout = np.array(minibatch)
-    observations = rollout[:, 0]
-    next_observations = rollout[:, 1]
-    actions = rollout[:, 2]
-
-    feed_dict = {self.local_network.observation: np.stack(observations, axis=0),
-                 self.local_network.target_next_obs: np.stack(next_observations, axis=0),
+    observations, next_observations, actions = self.aux_episode_buffer.sample(self.config.batch_size)
+
+    feed_dict = {self.local_network.observation: observations,
+                 self.local_network.target_next_obs: next_observations,
                  self.local_network.actions_placeholder: actions}
 
     aux_loss, _, ms = \
       self.sess.run([self.local_network.aux_loss, self.local_network.apply_grads_aux,
                      self.local_network.merged_summary_aux],
                     feed_dict=feed_dict)
+    self.global_network.bump_param_versions(self.local_network.updated_groups["aux"])
     return ms, aux_loss
 
   def train_option(self, bootstrap_value, bootstrap_value_mix):
-    rollout = np.array(self.episode_buffer_option)  # s, self.option, self.action, r, r_i
-    observations = rollout[:, 0]
-    options = rollout[:, 1]
-    actions = rollout[:, 2]
-    rewards = rollout[:, 3]
-    eigen_rewards = rollout[:, 4]
-    primitive_actions = rollout[:, 5]
-
-    rewards_plus = np.asarray(rewards.tolist() + [bootstrap_value])
+    rollout = self.episode_buffer_option
+    primitive_actions = rollout["primitive_actions"]
+
+    rewards_plus = np.append(rollout["rewards"], bootstrap_value)
     discounted_returns = reward_discount(rewards_plus, self.config.discount)[:-1]
 
-    options1, options2, actions1, actions2, discounted_returns1, discounted_returns2, \
-    observations1, observations2 = [], [], [], [], [], [], [], []
+    # Primitive options only train their critic and the other options the whole option loss, in a single update
+    feed_dict = {self.local_network.target_return: discounted_returns,
+                 self.local_network.observation: rollout["observations"],
+                 self.local_network.actions_placeholder: rollout["actions"],
+                 self.local_network.options_placeholder: rollout["options"],
+                 self.local_network.primitive_mask: primitive_actions.astype(np.float32)}
+    to_run = [self.local_network.apply_grads_option,
+              self.local_network.merged_summary_option,
+              self.local_network.option_loss,
+              self.local_network.policy_loss,
+              self.local_network.entropy_loss,
+              self.local_network.critic_loss,
+              self.local_network.term_loss]
 
     if self.config.eigen:
-      eigen_rewards_plus = np.asarray(eigen_rewards.tolist() + [bootstrap_value_mix])
+      eigen_rewards_plus = np.append(rollout["eigen_rewards"], bootstrap_value_mix)
       discounted_eigen_returns = discount(eigen_rewards_plus, self.config.discount)[:-1]
-      discounted_eigen_returns1, discounted_eigen_returns2 = [], []
-
-    for i, primitive in enumerate(primitive_actions):
-      if primitive:
-        options1.append(options[i])
-        actions1.append(actions[i])
-        discounted_returns1.append(discounted_returns[i])
-        if self.config.eigen:
-          discounted_eigen_returns1.append(discounted_eigen_returns[i])
-        observations1.append(observations[i])
-      else:
-        options2.append(options[i])
-        actions2.append(actions[i])
-        discounted_returns2.append(discounted_returns[i])
-        if self.config.eigen:
-          discounted_eigen_returns2.append(discounted_eigen_returns[i])
-        observations2.append(observations[i])
-
-    if len(observations1) > 0:
-      feed_dict = {self.local_network.target_return: discounted_returns1,
-                   self.local_network.observation: np.stack(observations1, axis=0),
-                   self.local_network.options_placeholder: options1}
-      to_run = [self.local_network.apply_grads_primitive_option]
-
-      _ = self.sess.run(to_run, feed_dict=feed_dict)
-
-    if len(observations2) > 0:
-
-      feed_dict = {self.local_network.target_return: discounted_returns2,
-                   self.local_network.observation: np.stack(observations2, axis=0),
-                   self.local_network.actions_placeholder: actions2,
-                   self.local_network.options_placeholder: options2}
-      to_run = [self.local_network.apply_grads_option,
-                self.local_network.merged_summary_option,
-                self.local_network.option_loss,
-                self.local_network.policy_loss,
-                self.local_network.entropy_loss,
-                self.local_network.critic_loss,
-                self.local_network.term_loss]
+      feed_dict[self.local_network.target_eigen_return] = discounted_eigen_returns
+      to_run.append(self.local_network.eigen_critic_loss)
 
-      if self.config.eigen:
-        feed_dict[self.local_network.target_eigen_return] = discounted_eigen_returns2
-        to_run.append(self.local_network.eigen_critic_loss)
-
-      results = self.sess.run(to_run, feed_dict=feed_dict)
-      results.append(discounted_returns[-1])
-      if self.config.eigen:
-        results.append(discounted_eigen_returns[-1])
-    else:
+    results = self.sess.run(to_run, feed_dict=feed_dict)
+    self.global_network.bump_param_versions(self.local_network.updated_groups["option"])
+    if np.all(primitive_actions):
       return None
 
+    results.append(discounted_returns[-1])
+    if self.config.eigen:
+      results.append(discounted_eigen_returns[-1])
+
     return results[1:]
 
   def evaluate_agent(self):
@@ -744,7 +719,7 @@ class BaseAgent():
           dx = 0
           dy = 0
           d = False
-          s, i, j = self.env.get_state(idx)
+          s, i, j = self.env.fake_get_state(idx)
           if not self.env.not_wall(i, j):
             plt.gca().add_patch(
               patches.Rectangle(
@@ -830,7 +805,7 @@ class BaseAgent():
             dx = 0
             dy = 0
             d = False
-            s, i, j = self.env.get_state(idx)
+            s, i, j = self.env.fake_get_state(idx)
             if not self.env.not_wall(i, j):
               plt.gca().add_patch(
                 patches.Rectangle(
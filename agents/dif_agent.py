@@ -2,6 +2,8 @@ import numpy as np
 import tensorflow as tf
 from tools.utils import update_target_graph, update_target_graph_aux, update_target_graph_sf, discount, \
   set_image_bandit, set_image_bandit_11_arms, make_gif
+from tools.replay_buffer import aux_replay_buffer
+from tools.summary_sink import summary_writer
 import os
 import matplotlib.patches as patches
 import matplotlib.pylab as plt
@@ -28,11 +30,12 @@ FLAGS = tf.app.flags.FLAGS
 
 
 class DIFAgent(Visualizer):
-  def __init__(self, game, thread_id, global_step, config):
+  def __init__(self, game, thread_id, global_step, config, global_network=None):
     self.name = "worker_" + str(thread_id)
     self.thread_id = thread_id
     self.optimizer = config.network_optimizer
     self.global_step = global_step
+    self.global_network = global_network
     self.model_path = os.path.join(config.stage_logdir, "models")
     self.summary_path = os.path.join(config.stage_logdir, "summaries")
 
@@ -54,7 +57,7 @@ class DIFAgent(Visualizer):
     self.total_steps = 0
     self.action_size = game.action_space.n
     self.nb_states = game.nb_states
-    self.summary_writer = tf.summary.FileWriter(self.summary_path + "/worker_" + str(self.thread_id))
+    self.summary_writer = summary_writer(self.summary_path + "/worker_" + str(self.thread_id), global_network)
     self.summary = tf.Summary()
 
     self.local_network = config.network(self.name, config, self.action_size, self.nb_states)
@@ -99,14 +102,10 @@ class DIFAgent(Visualizer):
     return ms, sf_loss
 
   def train_aux(self, sess):
-    minibatch = random.sample(self.aux_episode_buffer, self.config.batch_size)
-    rollout = np.array(minibatch)
-    observations = rollout[:, 0]
-    next_observations = rollout[:, 1]
-    actions = rollout[:, 2]
+    observations, next_observations, actions = self.aux_episode_buffer.sample(self.config.batch_size)
 
-    feed_dict = {self.local_network.observation: np.stack(observations, axis=0),
-                 self.local_network.target_next_obs: np.stack(next_observations, axis=0),
+    feed_dict = {self.local_network.observation: observations,
+                 self.local_network.target_next_obs: next_observations,
                  self.local_network.actions_placeholder: actions}
 
     aux_loss = \
@@ -124,7 +123,7 @@ class DIFAgent(Visualizer):
       self.total_steps_thread = self.total_steps
       ms_aux = ms_sf = None
       print("Starting worker " + str(self.thread_id))
-      self.aux_episode_buffer = deque()
+      self.aux_episode_buffer = aux_replay_buffer(self.config, self.env, self.global_network, self.thread_id)
 
       while not coord.should_stop():
         sess.run(self.update_local_vars_aux)
@@ -147,9 +146,7 @@ class DIFAgent(Visualizer):
           if d:
             s1 = s
           episode_buffer.append([s, s1, a])
-          if len(self.aux_episode_buffer) == self.config.memory_size:
-            self.aux_episode_buffer.popleft()
-          self.aux_episode_buffer.append([s, s1, a])
+          self.aux_episode_buffer.append(s, s1, a)
           s = s1
           self.total_steps_thread += 1
 
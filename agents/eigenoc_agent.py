@@ -1,9 +1,13 @@
 import numpy as np
 import tensorflow as tf
-from tools.utils import update_target_graph_aux, update_target_graph_sf, \
-  update_target_graph_option, discount, reward_discount, set_image, make_gif
+from tools.utils import update_local_graph, discount, reward_discount, set_image, make_gif, evaluate_state_space
+from tools.replay_buffer import aux_replay_buffer
+from tools.summary_sink import summary_writer
+from tools.step_counter import StepCounter
+from tools.rollout_buffer import RolloutBuffer
 import os
 
+from agents.eigenvector_service import recompute_directions
 from tools.ring_buffer import RingBuffer
 import matplotlib.patches as patches
 import matplotlib.pylab as plt
@@ -14,7 +18,7 @@ import mpl_toolkits.mplot3d.axes3d as axes3d
 import numpy as np
 from matplotlib import cm
 from collections import deque
-from agents.schedules import LinearSchedule, TFLinearSchedule
+from agents.schedules import LinearSchedule, TFLinearSchedule, DriftSchedule
 from PIL import Image
 import scipy.stats
 import seaborn as sns
@@ -52,9 +56,8 @@ class EigenOCAgent():
     tf.gfile.MakeDirs(self.model_path)
     tf.gfile.MakeDirs(self.summary_path)
     self.global_network = global_network
-    self.directions = self.global_network.directions
+    self.load_directions()
 
-    self.increment_global_step = self.global_step.assign_add(1)
     self.episode_rewards = []
     self.episode_lengths = []
     self.episode_mean_values = []
@@ -69,24 +72,45 @@ class EigenOCAgent():
     self.episode_actions = []
 
     self.total_steps_tensor = tf.Variable(0, dtype=tf.int32, name='total_steps_tensor', trainable=False)
-    self.increment_total_steps_tensor = self.total_steps_tensor.assign_add(1)
+    # Steps and episodes are counted in Python and added to total_steps_tensor and global_step in batches
+    self.step_counter = StepCounter(self.total_steps_tensor, config.steps_sync_interval)
+    self.episode_counter = StepCounter(self.global_step, config.episodes_sync_interval)
+    global_network.step_counters += [self.step_counter, self.episode_counter]
     self.total_steps = 0
     self.action_size = game.action_space.n
     self.nb_options = config.nb_options
     self.nb_states = game.nb_states
-    self.summary_writer = tf.summary.FileWriter(self.summary_path + "/worker_" + str(self.thread_id))
+    self.summary_writer = summary_writer(self.summary_path + "/worker_" + str(self.thread_id), global_network)
 
     self.local_network = config.network(self.name, config, self.action_size, self.nb_states, self.total_steps_tensor)
-
-    self.update_local_vars_aux = update_target_graph_aux('global', self.name)
-    self.update_local_vars_sf = update_target_graph_sf('global', self.name)
-    self.update_local_vars_option = update_target_graph_option('global', self.name)
+    self.episode_buffer_sf = RolloutBuffer(config.max_update_freq, [("observations", None)])
+    self.episode_buffer_option = RolloutBuffer(config.max_update_freq, [
+      ("observations", None), ("options", np.int32), ("actions", np.int32), ("rewards", np.float64),
+      ("eigen_rewards", np.float64), ("primitive_actions", np.bool_)])
+
+    self.update_local_vars = {group: update_local_graph('global', self.name, group)
+                              for group in ("aux", "sf", "option")}
+    # Versions of the global parameters last copied into the local network, per group
+    self.synced_versions = {}
+    self.recompute_schedule = DriftSchedule(config.eigen_drift_threshold, config.eigen_max_staleness,
+                                            config.eigen_nb_probes)
     self.env = game
     self.nb_states = game.nb_states
     # self.init_or_load_SR()
 
+  def sync_local_vars(self, group):
+    """Copies a group of global parameters into the local network, unless no gradient was applied to them since the
+    last copy. Returns whether they were copied."""
+    version = self.global_network.get_param_version(group)
+    if self.synced_versions.get(group) == version:
+      return False
+    self.sess.run(self.update_local_vars[group])
+    self.synced_versions[group] = version
+    return True
+
   def load_directions(self):
-    self.directions = self.global_network.directions
+    """Picks up the last directions published on the global network, between episodes."""
+    self.directions_version, self.directions, _ = self.global_network.get_directions()
 
   def play(self, sess, coord, saver):
     with sess.as_default(), sess.graph.as_default():
@@ -97,26 +121,28 @@ class EigenOCAgent():
       self.total_steps = sess.run(self.total_steps_tensor)
       self.eigen_q_value = None
       self.evalue = None
+      self.option = 0
+      self.carried_features = None
 
       ms_aux = ms_sf = ms_option = None
       tf.logging.info("Starting worker " +
                       str(self.thread_id))
-      self.aux_episode_buffer = deque()
+      self.aux_episode_buffer = aux_replay_buffer(self.config, self.env, self.global_network, self.thread_id)
 
       while not coord.should_stop():
         if self.total_steps > self.config.steps and self.name == "worker_0":
-          return 0
-        sess.run(self.update_local_vars_aux)
-        sess.run(self.update_local_vars_sf)
-        sess.run(self.update_local_vars_option)
+          break
+        self.sync_local_vars("aux")
+        self.sync_local_vars("sf")
+        self.sync_local_vars("option")
 
-        if self.name == "worker_0" and self.episode_count > 0:
+        if self.name == "worker_0" and self.episode_count > 0 and not self.config.eigen_service:
           self.recompute_eigenvectors_classic()
 
         self.load_directions()
 
-        self.episode_buffer_sf = []
-        self.episode_buffer_option = []
+        self.episode_buffer_sf.clear()
+        self.episode_buffer_option.clear()
         self.episode_values = []
         self.episode_q_values = []
         self.episode_eigen_q_values = []
@@ -134,16 +160,20 @@ class EigenOCAgent():
         self.eigen_R = 0
 
         s = self.env.reset()
-        self.option_evaluation(s)
+        step_results = self.step_evaluation([s], new_option=True)
+        self.carry_features(step_results)
+        self.apply_step_decisions(step_results, new_option=True)
         while not d:
-          if self.total_steps % self.config.target_update_iter_aux == 0:
-            sess.run(self.update_local_vars_aux)
-          if self.total_steps % self.config.target_update_iter_sf == 0:
-            sess.run(self.update_local_vars_sf)
+          if self.total_steps % self.config.target_update_iter_aux == 0 and self.sync_local_vars("aux"):
+            self.carried_features = None
+          if self.total_steps % self.config.target_update_iter_sf == 0 and self.sync_local_vars("sf"):
+            self.carried_features = None
           if self.total_steps % self.config.target_update_iter_option == 0:
-            sess.run(self.update_local_vars_option)
+            self.sync_local_vars("option")
 
-          self.policy_evaluation(s)
+          if self.total_steps <= self.config.eigen_exploration_steps:
+            self.action = np.random.choice(range(self.action_size))
+          self.episode_actions.append(self.action)
           s1, r, d, _ = self.env.step(self.action)
           r = np.clip(r, -1, 1)
           if d:
@@ -151,6 +181,16 @@ class EigenOCAgent():
           self.store_general_info(s, s1, self.action, r)
           if self.name == "worker_0":
             tf.logging.info("Episode {} >> Step {} >> Length: {}".format(self.episode_count, self.total_steps, t))
+
+          # A single session call per step: features and values of s and s1, and the decisions to act from s1
+          new_option = not d and self.total_steps > self.config.observation_steps and \
+                       self.total_steps > self.config.eigen_exploration_steps and (self.o_term or self.primitive_action)
+          step_results = self.transition_evaluation(s, s1, new_option)
+          if self.config.eigen:
+            fi, values, q_values, eigen_q_values, evalues, sfs = step_results[4:]
+          else:
+            fi, values, q_values = step_results[4:]
+
           if self.total_steps > self.config.observation_steps:
             t_counter_sf += 1
             if len(self.aux_episode_buffer) > self.config.observation_steps and \
@@ -158,17 +198,14 @@ class EigenOCAgent():
               ms_aux, aux_loss = self.train_aux()
 
             if self.config.eigen and (t_counter_sf == self.config.max_update_freq or d):
-              feed_dict = {self.local_network.observation: np.stack([s1])}
-              sf = sess.run(self.local_network.sf,
-                            feed_dict=feed_dict)[0]
-              bootstrap_sf = np.zeros_like(sf) if d else sf
+              bootstrap_sf = np.zeros_like(sfs[-1]) if d else sfs[-1]
               ms_sf, sf_loss = self.train_sf(bootstrap_sf)
-              self.episode_buffer_sf = []
+              self.episode_buffer_sf.clear()
               t_counter_sf = 0
 
             if self.total_steps > self.config.eigen_exploration_steps:
               t_counter_option += 1
-              self.store_option_info(s, s1, self.action, r)
+              self.store_option_info(s, s1, self.action, r, fi)
 
               if t_counter_option == self.config.max_update_freq or d or (
                     self.o_term and t_counter_option >= self.config.min_update_freq):
@@ -176,26 +213,13 @@ class EigenOCAgent():
                   R = 0
                   R_mix = 0
                 else:
-                  feed_dict = {self.local_network.observation: np.stack([s1])}
+                  q_value = q_values[-1, self.option]
+                  value = values[-1]
                   if self.config.eigen:
-                    value, evalue, q_value, q_eigen = sess.run(
-                      [self.local_network.v, self.local_network.eigenv, self.local_network.q_val,
-                       self.local_network.eigen_q_val],
-                      feed_dict=feed_dict)
-                    q_value = q_value[0, self.option]
-                    value = value[0]
-                    evalue = evalue[0]
                     if self.primitive_action:
                       R_mix = value if self.o_term else q_value
                     else:
-                      q_eigen = q_eigen[0, self.option]
-                      R_mix = evalue if self.o_term else q_eigen
-                  else:
-                    value, q_value = sess.run(
-                      [self.local_network.v, self.local_network.q_val],
-                      feed_dict=feed_dict)
-                    q_value = q_value[0, self.option]
-                    value = value[0]
+                      R_mix = evalues[-1] if self.o_term else eigen_q_values[-1, self.option]
                   R = value if self.o_term else q_value
                   if not self.config.eigen:
                     R_mix = R
@@ -206,25 +230,24 @@ class EigenOCAgent():
                   else:
                     ms_option, option_loss, policy_loss, entropy_loss, critic_loss, term_loss, self.R = results
 
-                self.episode_buffer_option = []
+                self.episode_buffer_option.clear()
                 t_counter_option = 0
 
-              if not d and (self.o_term or self.primitive_action):
-                self.option_evaluation(s1)
-                if not self.primitive_action:
-                  self.episode_options_lengths[self.option][-1] = self.total_steps - \
-                                                                  self.episode_options_lengths[self.option][-1]
-
             if self.total_steps % self.config.steps_checkpoint_interval == 0 and self.name == 'worker_0':
               self.save_model()
 
             if self.total_steps % self.config.steps_summary_interval == 0 and self.name == 'worker_0':
               self.write_step_summary(ms_sf, ms_aux, ms_option, r)
 
+          self.apply_step_decisions(step_results, new_option)
+          if new_option and not self.primitive_action:
+            self.episode_options_lengths[self.option][-1] = self.total_steps - \
+                                                            self.episode_options_lengths[self.option][-1]
+
           s = s1
           t += 1
           self.total_steps += 1
-          sess.run(self.increment_total_steps_tensor)
+          self.step_counter.add(sess)
 
         if self.name == "worker_0":
           tf.logging.info("Episode {} >> Step {} >> Length: {} >>> Reward: {}".format(self.episode_count,
@@ -269,85 +292,77 @@ class EigenOCAgent():
           self.write_episode_summary(ms_sf, ms_aux, ms_option, r)
 
         if self.name == 'worker_0':
-          sess.run(self.increment_global_step)
+          self.episode_counter.add(sess)
         self.episode_count += 1
 
-  def option_evaluation(self, s):
-    feed_dict = {self.local_network.observation: np.stack([s])}
-    self.option, self.primitive_action = self.sess.run(
-      [self.local_network.current_option, self.local_network.primitive_action], feed_dict=feed_dict)
-    self.option, self.primitive_action = self.option[0], self.primitive_action[0]
-    self.episode_options.append(self.option)
-    if not self.primitive_action:
-      self.episode_options_lengths[self.option].append(self.total_steps)
-
-  def policy_evaluation(self, s):
-    if self.total_steps > self.config.eigen_exploration_steps:
-      feed_dict = {self.local_network.observation: np.stack([s])}
-      to_run = [self.local_network.options, self.local_network.v, self.local_network.q_val,
-                self.local_network.termination]
-      if self.config.eigen:
-        to_run.append(self.local_network.eigen_q_val)
-        to_run.append(self.local_network.eigenv)
-      results = self.sess.run(to_run, feed_dict=feed_dict)
-      if self.config.eigen:
-        options, value, q_value, o_term, eigen_q_value, evalue = results
-        if not self.primitive_action:
-          self.eigen_q_value = eigen_q_value[0, self.option]
-          pi = options[0, self.option]
-          self.action = np.random.choice(pi, p=pi)
-          self.action = np.argmax(pi == self.action)
-          self.o_term = o_term[0, self.option] > np.random.uniform()
-          self.evalue = evalue[0]
-        else:
-          self.action = self.option - self.nb_options
-          self.o_term = True
-
-        self.q_value = q_value[0, self.option]
-        self.value = value[0]
-      else:
-        options, value, q_value, o_term = results
-        if self.config.include_primitive_options and self.primitive_action:
-          self.action = self.option - self.nb_options
-          self.o_term = True
-        else:
-          pi = options[0, self.option]
-          self.action = np.random.choice(pi, p=pi)
-          self.action = np.argmax(pi == self.action)
-          self.o_term = o_term[0, self.option] > np.random.uniform()
-        self.q_value = q_value[0, self.option]
-        self.value = value[0]
-    else:
-      self.action = np.random.choice(range(self.action_size))
-    self.episode_actions.append(self.action)
+      self.step_counter.sync(sess)
+      self.episode_counter.sync(sess)
+
+  def step_evaluation(self, observations, new_option):
+    """Runs the fused step op of the network on a batch of observations. Returns the option, primitive flag, action
+    and termination sample at the last observation, followed by the features and values of all of them."""
+    feed_dict = {self.local_network.observation: np.stack(observations),
+                 self.local_network.prev_option: self.option,
+                 self.local_network.new_option: new_option}
+    to_run = [self.local_network.step_option, self.local_network.step_primitive, self.local_network.step_action,
+              self.local_network.step_term, self.local_network.fi, self.local_network.v, self.local_network.q_val]
+    if self.config.eigen:
+      to_run += [self.local_network.eigen_q_val, self.local_network.eigenv, self.local_network.sf]
+    return self.sess.run(to_run, feed_dict=feed_dict)
+
+  def transition_evaluation(self, s, s1, new_option):
+    """Step op for the transition s -> s1. The features of s were computed on the previous step, where s was the
+    next observation, so only s1 is encoded unless the local fi/sf weights were synced since. The returned fi and
+    sf always have the rows of s and s1, values are those of s1 in the last row."""
+    if self.carried_features is None:
+      return self.carry_features(self.step_evaluation([s, s1], new_option))
+
+    fi, sf = self.carried_features
+    results = self.step_evaluation([s1], new_option)
+    results[4] = np.concatenate([fi[None], results[4]])
+    if self.config.eigen:
+      results[9] = np.concatenate([sf[None], results[9]])
+    return self.carry_features(results)
+
+  def carry_features(self, results):
+    self.carried_features = (results[4][-1], results[9][-1] if self.config.eigen else None)
+    return results
+
+  def apply_step_decisions(self, results, new_option):
+    option, primitive_action, self.action, self.o_term = results[:4]
+    if new_option:
+      self.option, self.primitive_action = option, primitive_action
+      self.episode_options.append(self.option)
+      if not self.primitive_action:
+        self.episode_options_lengths[self.option].append(self.total_steps)
+    self.value = results[5][-1]
+    self.q_value = results[6][-1, self.option]
+    if self.config.eigen and not self.primitive_action:
+      self.eigen_q_value = results[7][-1, self.option]
+      self.evalue = results[8][-1]
 
   def store_general_info(self, s, s1, a, r):
     if self.config.eigen:
-      self.episode_buffer_sf.append([s, s1, a])
-    if len(self.aux_episode_buffer) == self.config.memory_size:
-      self.aux_episode_buffer.popleft()
-    self.aux_episode_buffer.append([s, s1, a])
+      self.episode_buffer_sf.append(s)
+    self.aux_episode_buffer.append(s, s1, a)
     self.episode_reward += r
 
-  def store_option_info(self, s, s1, a, r):
+  def store_option_info(self, s, s1, a, r, fi):
     if self.config.eigen and not self.primitive_action:
-      feed_dict = {self.local_network.observation: np.stack([s, s1])}
-      fi = self.sess.run(self.local_network.fi,
-                         feed_dict=feed_dict)
       eigen_r = self.cosine_similarity((fi[1] - fi[0]), self.directions[self.option])
       r_i = self.config.alpha_r * eigen_r + (1 - self.config.alpha_r) * r
       self.episode_eigen_q_values.append(self.eigen_q_value)
-      self.episode_buffer_option.append(
-        [s, self.option, a, r, r_i, self.primitive_action])
+      self.episode_buffer_option.append(s, self.option, a, r, r_i, self.primitive_action)
     else:
       r_i = r
-      self.episode_buffer_option.append(
-        [s, self.option, a, r, r_i, self.primitive_action])
+      self.episode_buffer_option.append(s, self.option, a, r, r_i, self.primitive_action)
     self.episode_values.append(self.value)
     self.episode_q_values.append(self.q_value)
     self.episode_oterm.append(self.o_term)
 
   def save_model(self):
+    for counter in self.global_network.step_counters:
+      counter.sync(self.sess)
     self.saver.save(self.sess, self.model_path + '/model-{}.{}.cptk'.format(self.episode_count, self.total_steps),
                     global_step=self.global_step)
     tf.logging.info(
@@ -417,37 +432,19 @@ class EigenOCAgent():
     self.summary_writer.flush()
     self.write_step_summary(ms_sf, ms_aux, ms_option, r)
 
+  def recompute_eigenvectors(self, snapshot):
+    """Recomputes the directions from the SF matrix returned by snapshot() if the SFs drifted enough."""
+    summary, version = recompute_directions(self.sess, self.local_network, self.global_network, self.env,
+                                            self.recompute_schedule, self.episode_count, snapshot, self.config)
+    if version is not None:
+      self.load_directions()
+    self.summary_writer.add_summary(summary, self.episode_count)
+    self.summary_writer.flush()
+
   def recompute_eigenvectors_classic(self):
     if self.config.eigen:
-      # self.should_consider_eigenvectors = True
-      matrix_sf = np.zeros((self.nb_states, self.config.sf_layers[-1]))
-      for idx in range(self.nb_states):
-        s, ii, jj = self.env.fake_get_state(idx)
-        if self.env.not_wall(ii, jj):
-          feed_dict = {self.local_network.observation: [s]}
-          sf = self.sess.run(self.local_network.sf, feed_dict=feed_dict)[0]
-          matrix_sf[idx] = sf
-      feed_dict = {self.local_network.matrix_sf: matrix_sf}
-      eigenval, eigenvect = self.sess.run([self.local_network.eigenvalues, self.local_network.eigenvectors],
-                                          feed_dict=feed_dict)
-      # u, s, v = np.linalg.svd(self.sr_matrix_buffer.get(), full_matrices=False)
-      eigenvalues = eigenval[self.config.first_eigenoption:self.config.nb_options + self.config.first_eigenoption]
-      new_eigenvectors = eigenvect[self.config.first_eigenoption:self.config.nb_options + self.config.first_eigenoption]
-      min_similarity = np.min(
-        [self.cosine_similarity(a, b) for a, b in zip(self.global_network.directions, new_eigenvectors)])
-      max_similarity = np.max(
-        [self.cosine_similarity(a, b) for a, b in zip(self.global_network.directions, new_eigenvectors)])
-      mean_similarity = np.mean(
-        [self.cosine_similarity(a, b) for a, b in zip(self.global_network.directions, new_eigenvectors)])
-      self.summary = tf.Summary()
-      self.summary.value.add(tag='Eigenvectors/Min similarity', simple_value=float(min_similarity))
-      self.summary.value.add(tag='Eigenvectors/Max similarity', simple_value=float(max_similarity))
-      self.summary.value.add(tag='Eigenvectors/Mean similarity', simple_value=float(mean_similarity))
-      self.summary_writer.add_summary(self.summary, self.episode_count)
-      self.summary_writer.flush()
-      # tf.logging.warning("Min cosine similarity between old eigenvectors and recomputed onesis {}".format(min_similarity))
-      self.global_network.directions = new_eigenvectors
-      self.directions = self.global_network.directions
+      self.recompute_eigenvectors(
+        lambda: evaluate_state_space(self.sess, self.local_network, self.env, [self.local_network.sf])[0])
 
   def cosine_similarity(self, next_sf, evect):
     state_dif_norm = np.linalg.norm(next_sf)
@@ -458,117 +455,77 @@ class EigenOCAgent():
     return res
 
   def train_sf(self, bootstrap_sf):
-    rollout = np.array(self.episode_buffer_sf)
-
-    try:
-      observations = rollout[:, 0]
-    except:
-      print("Dasdas")
+    observations = self.episode_buffer_sf["observations"]
 
-    feed_dict = {self.local_network.observation: np.stack(observations, axis=0)}
+    feed_dict = {self.local_network.observation: observations}
     fi = self.sess.run(self.local_network.fi,
                        feed_dict=feed_dict)
 
-    sf_plus = np.asarray(fi.tolist() + [bootstrap_sf])
+    sf_plus = np.concatenate([fi, [bootstrap_sf]])
     discounted_sf = discount(sf_plus, self.config.discount)[:-1]
 
-    feed_dict = {self.local_network.target_sf: np.stack(discounted_sf, axis=0),
-                 self.local_network.observation: np.stack(observations, axis=0)}  # ,
+    feed_dict = {self.local_network.target_sf: discounted_sf,
+                 self.local_network.observation: observations}
 
     _, ms, sf_loss = \
       self.sess.run([self.local_network.apply_grads_sf,
                      self.local_network.merged_summary_sf,
                      self.local_network.sf_loss],
                     feed_dict=feed_dict)
+    self.global_network.bump_param_versions(self.local_network.updated_groups["sf"])
 
     return ms, sf_loss
 
   def train_aux(self):
-    minibatch = random.sample(self.aux_episode_buffer, self.config.batch_size)
-    rollout = np.array(minibatch)
-    observations = rollout[:, 0]
-    next_observations = rollout[:, 1]
-    actions = rollout[:, 2]
-
-    feed_dict = {self.local_network.observation: np.stack(observations, axis=0),
-                 self.local_network.target_next_obs: np.stack(next_observations, axis=0),
+    observations, next_observations, actions = self.aux_episode_buffer.sample(self.config.batch_size)
+
+    feed_dict = {self.local_network.observation: observations,
+                 self.local_network.target_next_obs: next_observations,
                  self.local_network.actions_placeholder: actions}
 
     aux_loss, _, ms = \
       self.sess.run([self.local_network.aux_loss, self.local_network.apply_grads_aux,
                      self.local_network.merged_summary_aux],
                     feed_dict=feed_dict)
+    self.global_network.bump_param_versions(self.local_network.updated_groups["aux"])
     return ms, aux_loss
 
   def train_option(self, bootstrap_value, bootstrap_value_mix):
-    rollout = np.array(self.episode_buffer_option)  # s, self.option, self.action, r, r_i
-    observations = rollout[:, 0]
-    options = rollout[:, 1]
-    actions = rollout[:, 2]
-    rewards = rollout[:, 3]
-    eigen_rewards = rollout[:, 4]
-    primitive_actions = rollout[:, 5]
-
-    rewards_plus = np.asarray(rewards.tolist() + [bootstrap_value])
+    rollout = self.episode_buffer_option
+    primitive_actions = rollout["primitive_actions"]
+
+    rewards_plus = np.append(rollout["rewards"], bootstrap_value)
     discounted_returns = reward_discount(rewards_plus, self.config.discount)[:-1]
 
-    options1, options2, actions1, actions2, discounted_returns1, discounted_returns2, \
-    observations1, observations2 = [], [], [], [], [], [], [], []
+    # Primitive options only train their critic and the other options the whole option loss, in a single update
+    feed_dict = {self.local_network.target_return: discounted_returns,
+                 self.local_network.observation: rollout["observations"],
+                 self.local_network.actions_placeholder: rollout["actions"],
+                 self.local_network.options_placeholder: rollout["options"],
+                 self.local_network.primitive_mask: primitive_actions.astype(np.float32)}
+    to_run = [self.local_network.apply_grads_option,
+              self.local_network.merged_summary_option,
+              self.local_network.option_loss,
+              self.local_network.policy_loss,
+              self.local_network.entropy_loss,
+              self.local_network.critic_loss,
+              self.local_network.term_loss]
 
     if self.config.eigen:
-      eigen_rewards_plus = np.asarray(eigen_rewards.tolist() + [bootstrap_value_mix])
+      eigen_rewards_plus = np.append(rollout["eigen_rewards"], bootstrap_value_mix)
       discounted_eigen_returns = discount(eigen_rewards_plus, self.config.discount)[:-1]
-      discounted_eigen_returns1, discounted_eigen_returns2 = [], []
-
-    for i, primitive in enumerate(primitive_actions):
-      if primitive:
-        options1.append(options[i])
-        actions1.append(actions[i])
-        discounted_returns1.append(discounted_returns[i])
-        if self.config.eigen:
-          discounted_eigen_returns1.append(discounted_eigen_returns[i])
-        observations1.append(observations[i])
-      else:
-        options2.append(options[i])
-        actions2.append(actions[i])
-        discounted_returns2.append(discounted_returns[i])
-        if self.config.eigen:
-          discounted_eigen_returns2.append(discounted_eigen_returns[i])
-        observations2.append(observations[i])
-
-    if len(observations1) > 0:
-      feed_dict = {self.local_network.target_return: discounted_returns1,
-                   self.local_network.observation: np.stack(observations1, axis=0),
-                   self.local_network.options_placeholder: options1}
-      to_run = [self.local_network.apply_grads_primitive_option]
-
-      _ = self.sess.run(to_run, feed_dict=feed_dict)
-
-    if len(observations2) > 0:
-
-      feed_dict = {self.local_network.target_return: discounted_returns2,
-                   self.local_network.observation: np.stack(observations2, axis=0),
-                   self.local_network.actions_placeholder: actions2,
-                   self.local_network.options_placeholder: options2}
-      to_run = [self.local_network.apply_grads_option,
-                self.local_network.merged_summary_option,
-                self.local_network.option_loss,
-                self.local_network.policy_loss,
-                self.local_network.entropy_loss,
-                self.local_network.critic_loss,
-                self.local_network.term_loss]
-
-      if self.config.eigen:
-        feed_dict[self.local_network.target_eigen_return] = discounted_eigen_returns2
-        to_run.append(self.local_network.eigen_critic_loss)
+      feed_dict[self.local_network.target_eigen_return] = discounted_eigen_returns
+      to_run.append(self.local_network.eigen_critic_loss)
 
-      results = self.sess.run(to_run, feed_dict=feed_dict)
-      results.append(discounted_returns[-1])
-      if self.config.eigen:
-        results.append(discounted_eigen_returns[-1])
-    else:
+    results = self.sess.run(to_run, feed_dict=feed_dict)
+    self.global_network.bump_param_versions(self.local_network.updated_groups["option"])
+    if np.all(primitive_actions):
       return None
 
+    results.append(discounted_returns[-1])
+    if self.config.eigen:
+      results.append(discounted_eigen_returns[-1])
+
     return results[1:]
 
   def evaluate_agent(self):
@@ -718,7 +675,7 @@ class EigenOCAgent():
           dx = 0
           dy = 0
           d = False
-          s, i, j = self.env.get_state(idx)
+          s, i, j = self.env.fake_get_state(idx)
           if not self.env.not_wall(i, j):
             plt.gca().add_patch(
               patches.Rectangle(
@@ -806,7 +763,7 @@ class EigenOCAgent():
             dx = 0
             dy = 0
             d = False
-            s, i, j = self.env.get_state(idx)
+            s, i, j = self.env.fake_get_state(idx)
             if not self.env.not_wall(i, j):
               plt.gca().add_patch(
                 patches.Rectangle(
@@ -0,0 +1,118 @@
+"""Recomputation of the eigen option directions, synchronously or from a background thread."""
+
+import os
+import threading
+import time
+
+import numpy as np
+import tensorflow as tf
+
+from agents.schedules import DriftSchedule
+from tools.eigen_solver import top_right_singular_vectors
+from tools.summary_sink import summary_writer
+from tools.utils import evaluate_state_space
+
+
+def solve_directions(global_network, matrix_sf, config):
+  """Top right singular vectors of matrix_sf, warm-started from the last published solve.
+
+  Returns the singular values and directions from first_eigenoption on, all the vectors of the solve (to warm-start
+  the next one) and the solver info.
+  """
+  first = config.first_eigenoption
+  k = first + config.nb_options
+  version, directions, init = global_network.get_directions()
+  if init is None:
+    init = np.zeros((k, matrix_sf.shape[1]))
+    init[first:] = directions
+  singular_values, vectors, solver_info = top_right_singular_vectors(
+    matrix_sf, k, init, tol=config.eigen_solver_tol, max_iters=config.eigen_solver_max_iters)
+  return singular_values[first:], vectors[first:], vectors, solver_info
+
+
+def probe_sf(sess, network, env, schedule):
+  """SFs of the probe states of a DriftSchedule, among the free cells of env."""
+  free_states, observations = env.get_free_observations()
+  probes = schedule.probe_indices(len(free_states))
+  return sess.run(network.sf, feed_dict={network.observation: observations[probes]})
+
+
+def directions_summary(old_directions, new_directions, solver_info):
+  """Similarity between the old and new directions and solver statistics."""
+  similarities = [np.dot(a / (np.linalg.norm(a) + 1e-8), b) for a, b in zip(old_directions, new_directions)]
+  summary = tf.Summary()
+  summary.value.add(tag='Eigenvectors/Min similarity', simple_value=float(np.min(similarities)))
+  summary.value.add(tag='Eigenvectors/Max similarity', simple_value=float(np.max(similarities)))
+  summary.value.add(tag='Eigenvectors/Mean similarity', simple_value=float(np.mean(similarities)))
+  summary.value.add(tag='Eigenvectors/Solver iterations', simple_value=float(solver_info["iterations"]))
+  summary.value.add(tag='Eigenvectors/Solver residual', simple_value=float(solver_info["residual"]))
+  summary.value.add(tag='Eigenvectors/Solver fallback', simple_value=float(solver_info["fallback"]))
+  return summary
+
+
+def recompute_directions(sess, network, global_network, env, schedule, episode_count, snapshot, config):
+  """Recomputes and publishes the option directions when schedule asks for it, given the drift of the SFs of its
+  probe states under network. snapshot() returns the SF matrix to decompose.
+
+  Returns the summary of the attempt and the published version, None when the recompute was skipped.
+  """
+  start = time.time()
+  probe = probe_sf(sess, network, env, schedule)
+  summary = tf.Summary()
+  version = None
+  if schedule.should_recompute(probe, episode_count):
+    matrix_sf = snapshot()
+    _, old_directions, _ = global_network.get_directions()
+    _, directions, eigen_basis, solver_info = solve_directions(global_network, matrix_sf, config)
+    version = global_network.publish_directions(directions, eigen_basis)
+    schedule.record_recompute(probe, episode_count, time.time() - start)
+
+    summary = directions_summary(old_directions, directions, solver_info)
+    summary.value.add(tag='Eigenvectors/Version', simple_value=float(version))
+    summary.value.add(tag='Eigenvectors/Recompute time', simple_value=float(time.time() - start))
+  schedule.add_summary(summary)
+  return summary, version
+
+
+class EigenvectorService(threading.Thread):
+  """Background thread that owns the SF snapshot and the decomposition of the option directions.
+
+  Every eigen_service_interval seconds it checks the drift of the SFs of a few probe states. When a DriftSchedule asks
+  for it, it snapshots the SFs, either of every state with the global network (eigen_service_snapshot = "state_space")
+  or the global sf_matrix_buffer ("sf_buffer"), solves for the directions and publishes them with
+  global_network.publish_directions. Workers pick the new version up at their next episode boundary with
+  load_directions, so no worker waits on the decomposition.
+  """
+
+  def __init__(self, sess, coord, global_network, env, global_step, config):
+    threading.Thread.__init__(self, name="eigenvector_service")
+    self.daemon = True
+    self.sess = sess
+    self.coord = coord
+    self.global_network = global_network
+    self.env = env
+    self.global_step = global_step
+    self.config = config
+    self.schedule = DriftSchedule(config.eigen_drift_threshold, config.eigen_max_staleness, config.eigen_nb_probes)
+    self.summary_writer = summary_writer(
+      os.path.join(config.stage_logdir, "summaries", "eigenvector_service"), global_network)
+
+  def snapshot(self):
+    if self.config.eigen_service_snapshot == "sf_buffer":
+      return self.global_network.sf_matrix_buffer.snapshot()
+    matrix_sf, = evaluate_state_space(self.sess, self.global_network, self.env, [self.global_network.sf])
+    return matrix_sf
+
+  def recompute(self, episode_count):
+    self.env.set_goal(episode_count, self.config.move_goal_nb_of_ep)
+    summary, _ = recompute_directions(self.sess, self.global_network, self.global_network, self.env, self.schedule,
+                                      episode_count, self.snapshot, self.config)
+    self.summary_writer.add_summary(summary, episode_count)
+    self.summary_writer.flush()
+
+  def run(self):
+    with self.coord.stop_on_exception(), self.sess.as_default(), self.sess.graph.as_default():
+      while not self.coord.wait_for_stop(self.config.eigen_service_interval):
+        episode_count = self.sess.run(self.global_step)
+        if episode_count > 0:
+          self.recompute(episode_count)
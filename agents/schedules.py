@@ -1,3 +1,4 @@
+import numpy as np
 import tensorflow as tf
 
 class LinearSchedule(object):
@@ -57,4 +58,67 @@ class TFLinearSchedule(object):
                               tf.constant(1.0, dtype=tf.float32))
         # self.steps += 1
 
-        return self.initial_p + fraction * (self.final_p - self.initial_p)
\ No newline at end of file
+        return self.initial_p + fraction * (self.final_p - self.initial_p)
+
+
+class DriftSchedule(object):
+    def __init__(self, threshold, max_staleness, nb_probes, seed=0):
+        """Decides when the option directions need to be recomputed from
+        the drift of the SFs of a small fixed probe set of states since the
+        last recompute.
+        Parameters
+        ----------
+        threshold: float
+            relative change ||SF - SF_ref|| / ||SF_ref|| of the probe SFs
+            past which the directions are recomputed
+        max_staleness: int
+            number of episodes after which the directions are recomputed
+            whatever the drift
+        nb_probes: int
+            number of probe states
+        """
+        self.threshold = threshold
+        self.max_staleness = max_staleness
+        self.nb_probes = nb_probes
+        self.rng = np.random.RandomState(seed)
+        self.probes = None
+        self.reference = None
+        self.last_recompute = None
+        self.drift = 0.
+        self.nb_recomputes = 0
+        self.nb_skipped = 0
+        self.recompute_time = 0.
+
+    def probe_indices(self, nb_states):
+        """Positions of the probe states among the nb_states candidates"""
+        if self.probes is None or self.probes.max() >= nb_states:
+            self.probes = np.sort(self.rng.choice(nb_states, min(self.nb_probes, nb_states), replace=False))
+        return self.probes
+
+    def should_recompute(self, probe_sf, t):
+        """Whether to recompute at episode t given the current probe SFs.
+        Skipped recomputes are counted."""
+        if self.reference is None or self.reference.shape != probe_sf.shape:
+            return True
+        self.drift = np.linalg.norm(probe_sf - self.reference) / (np.linalg.norm(self.reference) + 1e-8)
+        if self.drift > self.threshold or t - self.last_recompute >= self.max_staleness:
+            return True
+        self.nb_skipped += 1
+        return False
+
+    def record_recompute(self, probe_sf, t, duration):
+        """Makes probe_sf the new reference after a recompute that took
+        duration seconds"""
+        self.reference = probe_sf
+        self.last_recompute = t
+        self.nb_recomputes += 1
+        self.recompute_time += duration
+
+    def add_summary(self, summary):
+        """Adds the recompute counts and the estimated time saved by the
+        skipped recomputes to a tf.Summary"""
+        mean_time = self.recompute_time / max(self.nb_recomputes, 1)
+        summary.value.add(tag='Eigenvectors/SF drift', simple_value=float(self.drift))
+        summary.value.add(tag='Eigenvectors/Recomputes', simple_value=float(self.nb_recomputes))
+        summary.value.add(tag='Eigenvectors/Skipped recomputes', simple_value=float(self.nb_skipped))
+        summary.value.add(tag='Eigenvectors/Saved time', simple_value=float(self.nb_skipped * mean_time))
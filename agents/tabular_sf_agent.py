@@ -6,6 +6,8 @@ from collections import deque
 from agents.schedules import LinearSchedule, TFLinearSchedule
 from PIL import Image
 import scipy.stats
+import scipy.sparse
+import scipy.sparse.linalg
 import random
 import math
 
@@ -57,20 +59,39 @@ class TabSFAgent():
                feed_dict=feed_dict)
     return ms, img_summ, loss, sf_loss
 
+  def build_random_walk(self):
+    """Sparse transition matrix of the uniform random policy, taken from the compiled env model when there is one."""
+    next_state_table = getattr(self.env, 'next_state_table', None)
+    if next_state_table is None:
+      next_state_table = np.array([[self.env.get_next_state_and_reward(s, a)[0] for a in range(self.action_size)]
+                                   for s in range(self.nb_states)])
+    rows = np.repeat(np.arange(self.nb_states), self.action_size)
+    probs = np.full(rows.shape, 1. / self.action_size)
+    return scipy.sparse.csc_matrix((probs, (rows, next_state_table.ravel())), shape=(self.nb_states, self.nb_states))
+
   def sf_eval(self):
-    ''' Policy evaluation step.'''
-    delta = 0.0
-    for s in range(self.nb_states):
-      sf = self.sf[s]
-      a = np.random.choice(range(self.action_size))
-      nextS, nextR = self.env.get_next_state_and_reward(
-        s, a)
-      state_features = np.identity(self.nb_states)
-      self.sf[s] = state_features[s] + self.config.gamma * self.sf[nextS]
-      delta = max(delta, math.fabs(sf - self.sf[s]))
+    """Computes the successor representation of the random walk in closed form, SR = (I - gamma P)^-1, with a sparse
+    LU factorization. Returns the largest change in the SR."""
+    P = self.build_random_walk()
+    lu = scipy.sparse.linalg.splu(scipy.sparse.identity(self.nb_states, format='csc') - self.config.gamma * P)
+    sf = lu.solve(np.identity(self.nb_states))
+    delta = np.max(np.abs(sf - self.sf))
+    self.sf = sf
 
     return delta
 
+  def sr_eigenvectors(self, k=None):
+    """Top k singular values and vectors of the successor representation, a ground-truth reference for the
+    eigenvectors recovered from the learned sf_matrix. Walls are left out of the decomposition and are 0 in the
+    returned vectors."""
+    free = np.ones(self.nb_states, dtype=bool)
+    if getattr(self.env, 'MDP', None) is not None:
+      free = self.env.MDP.ravel() != -1
+    _, s, v = np.linalg.svd(self.sf[np.ix_(free, free)])
+    eigenvectors = np.zeros((len(s), self.nb_states))
+    eigenvectors[:, free] = v
+    return s[:k], eigenvectors[:k]
+
   def play(self, sess, coord, saver):
     # with sess.as_default(), sess.graph.as_default():
     #   episode_count = 0
@@ -86,11 +107,9 @@ class TabSFAgent():
     #     t_counter = 0
     #     R = 0
     #     old_sf = None
-    delta = np.inf
-    while (self.theta < delta):
-      delta = self.sf_eval()
+    self.sf_eval()
 
-    u, s, v = np.linalg.svd(self.sf)
+    s, v = self.sr_eigenvectors()
     print(s)
 
 
@@ -1,6 +1,6 @@
-import math
-
 import numpy as np
+import scipy.sparse
+import scipy.sparse.linalg
 
 
 class PolicyIteration:
@@ -18,60 +18,90 @@ class PolicyIteration:
         self.nb_states = env.nb_states + 1
 
         self.V = np.zeros(self.nb_states + 1)
-        self.pi = np.zeros(self.nb_states + 1, dtype=np.int)
+        self.pi = np.zeros(self.nb_states + 1, dtype=int)
 
         if augmentActionSet:
             self.actionSet = np.append(env.get_action_set(), [4])
         else:
             self.actionSet = env.get_action_set()
 
+    def _buildModel(self):
+        '''Builds the (nb_states, nb_actions) next-state and reward tables
+           of the environment, so that evaluation and improvement are array
+           operations. The last state is the absorbing one reached by
+           terminating. Called by every solve, as the reward function of the
+           environment may have changed since the last one.'''
+        nb_actions = len(self.actionSet)
+        env = self.environment
+        if getattr(env, 'next_state_table', None) is not None and \
+                getattr(env, 'reward_table', None) is not None:
+            nb_primitive = env.next_state_table.shape[1]
+            self.nextStates = np.full((self.nb_states, nb_actions),
+                                      env.nb_states, dtype=np.int32)
+            self.rewards = np.zeros((self.nb_states, nb_actions))
+            nb_moves = min(nb_primitive, nb_actions)
+            self.nextStates[:-1, :nb_moves] = env.next_state_table[:, :nb_moves]
+            self.rewards[:-1, :nb_moves] = env.reward_table[:, :nb_moves]
+        else:
+            self.nextStates = np.zeros((self.nb_states, nb_actions),
+                                       dtype=np.int32)
+            self.rewards = np.zeros((self.nb_states, nb_actions))
+            for s in range(self.nb_states):
+                for a in range(nb_actions):
+                    self.nextStates[s, a], self.rewards[s, a] = \
+                        env.get_next_state_and_reward(s, a)
+
+    def _solveLinear(self, probs, nextStates, rewards):
+        '''Solves V = r_pi + gamma * P_pi V exactly for a (possibly
+           stochastic) policy given as action probabilities per state.'''
+        nb_states = self.nb_states
+        rows = np.repeat(np.arange(nb_states), probs.shape[1])
+        P = scipy.sparse.csr_matrix(
+            (probs.ravel(), (rows, nextStates.ravel())),
+            shape=(nb_states, nb_states))
+        A = scipy.sparse.identity(nb_states, format='csc') - self.gamma * P
+        b = np.sum(probs * rewards, axis=1)
+
+        V = np.zeros(nb_states + 1)
+        V[:nb_states] = scipy.sparse.linalg.spsolve(A.tocsc(), b)
+        return V
+
     def _evalPolicy(self):
         ''' Policy evaluation step.'''
-        delta = 0.0
-        for s in range(self.nb_states):
-            v = self.V[s]
-            nextS, nextR = self.environment.get_next_state_and_reward(
-                s, self.pi[s])
-
-            self.V[s] = nextR + self.gamma * self.V[nextS]
-            delta = max(delta, math.fabs(v - self.V[s]))
+        probs = np.zeros((self.nb_states, len(self.actionSet)))
+        probs[np.arange(self.nb_states), self.pi[:self.nb_states]] = 1.
+        V = self._solveLinear(probs, self.nextStates, self.rewards)
+        delta = np.max(np.abs(V - self.V))
+        self.V = V
 
         return delta
 
     def _improvePolicy(self):
         ''' Policy improvement step. '''
-        policy_stable = True
-        for s in range(self.nb_states):
-            old_action = self.pi[s]
-            tempV = [0.0] * len(self.actionSet)
-            # I first get all value-function estimates
-            for i in range(len(self.actionSet)):
-                nextS, nextR = self.environment.get_next_state_and_reward(
-                    s, i)
-                tempV[i] = nextR + self.gamma * self.V[nextS]
-
-            # Now I take the argmax
-            self.pi[s] = np.argmax(tempV)
-            # I break ties always choosing to terminate:
-            if math.fabs(tempV[self.pi[s]] - tempV[(len(self.actionSet) - 1)]) < 0.001:
-                self.pi[s] = (len(self.actionSet) - 1)
-            if old_action != self.pi[s]:
-                policy_stable = False
-
-        return policy_stable
+        old_pi = self.pi[:self.nb_states].copy()
+        tempV = self.rewards + self.gamma * self.V[self.nextStates]
+
+        states = np.arange(self.nb_states)
+        pi = np.argmax(tempV, axis=1)
+        best = tempV[states, pi]
+        # I break ties always choosing to terminate:
+        pi[np.abs(best - tempV[:, -1]) < 0.001] = len(self.actionSet) - 1
+        self.pi[:self.nb_states] = pi
+
+        return np.array_equal(old_pi, pi)
 
     def solvePolicyIteration(self, theta=0.001):
         ''' Implementation of Policy Iteration, as in the policy iteration
-            pseudo-code presented in Sutton and Barto (2016).'''
+            pseudo-code presented in Sutton and Barto (2016). Evaluation is
+            an exact sparse solve, so theta is not needed anymore.'''
 
         # Initialization is done in the constructor
+        self._buildModel()
         policy_stable = False
 
         while not policy_stable:
             # Policy evaluation
-            delta = self._evalPolicy()
-            while (theta < delta):
-                delta = self._evalPolicy()
+            self._evalPolicy()
 
             # Policy improvement
             policy_stable = self._improvePolicy()
@@ -79,40 +109,24 @@ class PolicyIteration:
         return self.V, self.pi
 
     def solvePolicyEvaluation(self, pi, theta=0.001):
-        '''Implementation of Policy Evaluation, as in the policy evaluation
-           pseudo-code presented in Sutton and Barto (2016).'''
-
-        # I'll use the same V, it shouldn't really matter,
-        # although ideally these things should be independent
-        self.V = np.zeros(self.numStates + 1)
-        iteration = 1
-
-        delta = 1
-        while delta > theta:
-            delta = 0
-            for s in range(self.numStates - 1):
-                v = self.V[s]
-                tempSum = 0
-                for a in range(len(pi[s])):
-                    nextS, nextR = self.environment.getNextStateAndReward(
-                        s, a)
-                    tempSum += pi[s][a] * 1.0 * (
-                        nextR + self.gamma * self.V[nextS])
-
-                self.V[s] = tempSum
-                delta = max(delta, math.fabs(v - self.V[s]))
-
-            if iteration % 1000 == 0:
-                print('Iteration:', iteration, '\tDelta:', delta)
-            iteration += 1
-
-        '''
-        import sys
-        for i in xrange(16):
-          sys.stdout.write(str(self.V[i]) + ' ')
-          if (i + 1) % 4 == 0:
-            print
-        '''
+        '''Evaluates a stochastic policy, pi[s][a] being the probability of
+           taking action a in state s. States without a row in pi keep a
+           value of 0.'''
+        self._buildModel()
+        pi = np.asarray(pi, dtype=np.float64)
+        nb_rows = min(len(pi), self.nb_states - 1)
+        nb_actions = pi.shape[1]
+
+        probs = np.zeros((self.nb_states, nb_actions))
+        probs[:nb_rows] = pi[:nb_rows]
+        nextStates = self.nextStates[:, :nb_actions].copy()
+        # States without a policy are absorbing
+        nextStates[nb_rows:] = np.arange(nb_rows, self.nb_states)[:, None]
+        probs[nb_rows:, 0] = 1.
+        rewards = self.rewards[:, :nb_actions].copy()
+        rewards[nb_rows:] = 0.
+
+        self.V = self._solveLinear(probs, nextStates, rewards)
         return self.V
 
     def solveBellmanEquations(self, pi, fullActionSet, optionsActionSet):
@@ -1,6 +1,7 @@
 import numpy as np
 import tensorflow as tf
-from tools.utils import update_target_graph, discount, set_image_bandit, set_image_bandit_11_arms, make_gif
+from tools.utils import update_target_graph, discount, set_image_bandit, set_image_bandit_11_arms, make_gif, \
+  evaluate_state_space
 import os
 import matplotlib.patches as patches
 import matplotlib.pylab as plt
@@ -68,14 +69,8 @@ class Visualizer():
       self.matrix_fi = np.load(matrix_fi_path)
     else:
       with sess.as_default(), sess.graph.as_default():
-        self.matrix_sf = np.zeros((self.nb_states, self.config.sf_layers[-1]))
-        self.matrix_fi = np.zeros((self.nb_states, self.config.sf_layers[-1]))
-        for idx in range(self.nb_states):
-          s, ii, jj = self.env.get_state(idx)
-          if self.env.not_wall(ii, jj):
-            feed_dict = {self.local_network.observation: [s]}
-            fi, sf = sess.run([self.local_network.fi, self.local_network.sf], feed_dict=feed_dict)
-            self.matrix_fi[idx], self.matrix_sf[idx] = fi[0], sf[0]
+        self.matrix_fi, self.matrix_sf = evaluate_state_space(sess, self.local_network, self.env,
+                                                              [self.local_network.fi, self.local_network.sf])
 
             # plt.pcolor(self.matrix_sf, cmap='hot', interpolation='nearest')
             # plt.savefig(os.path.join(self.summary_path, 'SR_matrix.png'))
@@ -474,7 +469,7 @@ class Visualizer():
             dx = 0
             dy = 0
             d = False
-            s, i, j = self.env.get_state(idx)
+            s, i, j = self.env.fake_get_state(idx)
 
             if not self.env.not_wall(i, j):
               plt.gca().add_patch(
@@ -0,0 +1,131 @@
+"""Measures how the eigenoption pipeline scales with the size of the map.
+
+For every generated layout and size it reports the env steps per second, the wall time of
+recompute_eigenvectors_classic and the memory taken by one worker (env and local network).
+
+  python benchmark_scaling.py --config eigenoc_dyn --kinds rooms,maze --sizes 13,25,51,101,201
+"""
+
+import datetime
+import functools
+import os
+import resource
+import time
+
+import numpy as np
+import tensorflow as tf
+
+import configs
+import tools
+from env_wrappers import GridWorld
+from env_wrappers import _create_environment
+from env_wrappers.map_generator import generate_map
+
+
+def memory_usage():
+  """Resident memory of the process in bytes."""
+  try:
+    with open("/proc/self/statm") as f:
+      return int(f.read().split()[1]) * resource.getpagesize()
+  except IOError:
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def benchmark_steps(env, nb_steps):
+  env.reset()
+  start = time.time()
+  for _ in range(nb_steps):
+    _, _, done, _ = env.step(np.random.randint(env.action_space.n))
+    if done:
+      env.reset()
+  return nb_steps / (time.time() - start)
+
+
+def benchmark_map(config, map_path):
+  tf.reset_default_graph()
+  with config.unlocked:
+    grid = GridWorld([(1, 1)], map_path, headless=True)
+    config.goal_locations = [(grid.goalX, grid.goalY)]
+    config.env = functools.partial(GridWorld, config.goal_locations, map_path, headless=True)
+    # recompute_eigenvectors_classic feeds one SF per state to matrix_sf
+    config.sf_matrix_size = grid.nb_states
+    # FrameResize does not resize, so the networks take the screens of the map as they are
+    config.input_size = (grid.nb_rows, grid.nb_cols)
+    config.aux_fc_layers = tuple(config.aux_fc_layers[:-1]) + (grid.nb_rows * grid.nb_cols * config.history_size,)
+  stats = dict(nb_states=grid.nb_states, free_cells=int(np.sum(grid.MDP != -1)))
+
+  with tf.Session() as sess, tf.device("/cpu:0"):
+    global_step = tf.Variable(0, dtype=tf.int32, name='global_step', trainable=False)
+    memory = memory_usage()
+    env = _create_environment(config)
+    env.reset()
+    stats["env_memory_mb"] = (memory_usage() - memory) / 2. ** 20
+    global_network = config.network("global", config, env.action_space.n, env.nb_states)
+
+    memory = memory_usage()
+    agent = config.dif_agent(env, 0, global_step, config, global_network)
+    sess.run([tf.global_variables_initializer(), tf.local_variables_initializer()])
+    stats["worker_memory_mb"] = stats["env_memory_mb"] + (memory_usage() - memory) / 2. ** 20
+
+    stats["steps_per_sec"] = benchmark_steps(env, FLAGS.nb_steps)
+
+    with sess.as_default(), sess.graph.as_default():
+      agent.sess = sess
+      agent.episode_count = 0
+      agent.sync_local_vars("sf")
+      start = time.time()
+      agent.recompute_eigenvectors_classic()
+      stats["recompute_sec"] = time.time() - start
+
+  return stats
+
+
+def main(_):
+  logdir = os.path.join(FLAGS.logdir, "{}-benchmark".format(FLAGS.timestamp))
+  map_dir = os.path.join(logdir, "maps")
+  config = tools.AttrDict(getattr(configs, FLAGS.config)())
+  with config.unlocked:
+    config.logdir = logdir
+    config.stage_logdir = os.path.join(logdir, "dif")
+    config.network_optimizer = getattr(tf.train, config.network_optimizer)
+  tf.gfile.MakeDirs(config.stage_logdir)
+
+  row = "{:>6} {:>5} {:>8} {:>8} {:>12} {:>14} {:>11} {:>11}"
+  print(row.format("kind", "size", "states", "free", "steps/sec", "recompute(s)", "env(MB)", "worker(MB)"))
+  for kind in FLAGS.kinds.split(","):
+    for size in [int(s) for s in FLAGS.sizes.split(",")]:
+      map_path = generate_map(kind, size, size, os.path.join(map_dir, "{}_{}.mdp".format(kind, size)),
+                              FLAGS.nb_rooms, FLAGS.seed)
+      stats = benchmark_map(config, map_path)
+      print(row.format(kind, size, stats["nb_states"], stats["free_cells"], "{:.1f}".format(stats["steps_per_sec"]),
+                       "{:.3f}".format(stats["recompute_sec"]), "{:.1f}".format(stats["env_memory_mb"]),
+                       "{:.1f}".format(stats["worker_memory_mb"])))
+
+
+if __name__ == '__main__':
+  FLAGS = tf.app.flags.FLAGS
+  tf.app.flags.DEFINE_string(
+    'logdir', './logdir',
+    'Base directory to store the generated maps and the worker logs.')
+  tf.app.flags.DEFINE_string(
+    'timestamp', datetime.datetime.now().strftime('%Y%m%dT%H%M%S'),
+    'Sub directory to store logs.')
+  tf.app.flags.DEFINE_string(
+    'config', "eigenoc_dyn",
+    'Configuration to benchmark.')
+  tf.app.flags.DEFINE_string(
+    'kinds', "rooms,maze",
+    'Comma separated layouts to generate.')
+  tf.app.flags.DEFINE_string(
+    'sizes', "13,25,51,101,201",
+    'Comma separated sizes of the square maps.')
+  tf.app.flags.DEFINE_integer(
+    'nb_rooms', 4,
+    'Number of rooms of the rooms layout.')
+  tf.app.flags.DEFINE_integer(
+    'nb_steps', 10000,
+    'Number of env steps timed per map.')
+  tf.app.flags.DEFINE_integer(
+    'seed', 0,
+    'Seed of the map generator.')
+  tf.app.run()
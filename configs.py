@@ -471,6 +471,19 @@ def oc():
   min_update_freq = 5
   batch_size = 32
   memory_size = 100000
+  # Store GridWorld transitions in the aux replay as state indices and render them back at sample time
+  compact_replay = False
+  # A single aux replay memory shared by all the workers instead of one memory_size replay per worker
+  shared_replay = False
+  # Queue the summaries of all the workers to one background writer thread, flushed every summary_flush_secs
+  summary_sink = False
+  summary_queue_size = 1000
+  summary_flush_secs = 10
+  # Publish the step and episode counts of the workers to total_steps_tensor and global_step every so many of them
+  # Anything reading total_steps_tensor or global_step in the graph (decay schedules, checkpoints) sees them lag by up
+  # to steps_sync_interval - 1 steps and episodes_sync_interval - 1 episodes per worker. Set both to 1 for exact counts
+  steps_sync_interval = 100
+  episodes_sync_interval = 1
   observation_steps = 16*4
   aux_update_freq = 1
   steps = 1000000  # 1M
@@ -533,6 +546,19 @@ def eigenoc():
   min_update_freq = 5
   batch_size = 32
   memory_size = 100000
+  # Store GridWorld transitions in the aux replay as state indices and render them back at sample time
+  compact_replay = False
+  # A single aux replay memory shared by all the workers instead of one memory_size replay per worker
+  shared_replay = False
+  # Queue the summaries of all the workers to one background writer thread, flushed every summary_flush_secs
+  summary_sink = False
+  summary_queue_size = 1000
+  summary_flush_secs = 10
+  # Publish the step and episode counts of the workers to total_steps_tensor and global_step every so many of them
+  # Anything reading total_steps_tensor or global_step in the graph (decay schedules, checkpoints) sees them lag by up
+  # to steps_sync_interval - 1 steps and episodes_sync_interval - 1 episodes per worker. Set both to 1 for exact counts
+  steps_sync_interval = 100
+  episodes_sync_interval = 1
   observation_steps = 16*4
   aux_update_freq = 1
   alpha_r = 0.75
@@ -560,6 +586,18 @@ def eigenoc():
   move_goal_nb_of_ep = 1000
   include_primitive_options = True
   sr_matrix_size = 169
+  eigen_solver_tol = 1e-6
+  eigen_solver_max_iters = 200
+  # Recompute the directions in a background thread instead of at the episode starts of worker_0 (opt-in: the
+  # recompute then follows wall-clock time rather than episodes)
+  eigen_service = False
+  eigen_service_interval = 5
+  eigen_service_snapshot = "state_space"
+  # Recompute only when the SFs of eigen_nb_probes probe states moved by more than eigen_drift_threshold (relative)
+  # since the last recompute, or eigen_max_staleness episodes after it
+  eigen_drift_threshold = 0.05
+  eigen_max_staleness = 100
+  eigen_nb_probes = 32
 
   return locals()
 
@@ -571,6 +609,7 @@ def eigenoc_dyn():
 
   sf_matrix_size = 10000
   steps = 10000000  # 10M
+  eigen_service_snapshot = "sf_buffer"
 
   return locals()
 
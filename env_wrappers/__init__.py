@@ -4,4 +4,5 @@ from __future__ import print_function
 
 from .txt_wrapper import GridWorld
 from .non_matching_game import Gridworld_NonMatching
+from .vec_gridworld import VecGridWorld
 from .utils import _create_environment
\ No newline at end of file
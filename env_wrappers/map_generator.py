@@ -0,0 +1,103 @@
+"""Procedural N-room and maze layouts written in the .mdp format of mdps/."""
+
+import argparse
+import os
+
+import numpy as np
+
+
+def rooms_layout(nb_rows, nb_cols, nb_rooms=4, rng=None):
+  """Splits the grid into a near-square arrangement of nb_rooms rooms, with one random doorway in every wall between
+  two neighbouring rooms."""
+  rng = rng or np.random
+  room_rows = int(np.floor(np.sqrt(nb_rooms)))
+  while nb_rooms % room_rows:
+    room_rows -= 1
+  room_cols = nb_rooms // room_rows
+
+  grid = np.full((nb_rows, nb_cols), '.')
+  grid[[0, -1], :] = 'X'
+  grid[:, [0, -1]] = 'X'
+  row_walls = np.linspace(0, nb_rows - 1, room_rows + 1).astype(int)
+  col_walls = np.linspace(0, nb_cols - 1, room_cols + 1).astype(int)
+  if np.any(np.diff(row_walls) < 3) or np.any(np.diff(col_walls) < 3):
+    raise ValueError("A {}x{} grid is too small for {} rooms".format(nb_rows, nb_cols, nb_rooms))
+
+  for wall in row_walls[1:-1]:
+    grid[wall, :] = 'X'
+  for wall in col_walls[1:-1]:
+    grid[:, wall] = 'X'
+  for wall in row_walls[1:-1]:
+    for left, right in zip(col_walls[:-1], col_walls[1:]):
+      grid[wall, rng.randint(left + 1, right)] = '.'
+  for wall in col_walls[1:-1]:
+    for top, bottom in zip(row_walls[:-1], row_walls[1:]):
+      grid[rng.randint(top + 1, bottom), wall] = '.'
+
+  grid[nb_rows - 2, 1] = 'S'
+  grid[1, nb_cols - 2] = 'G'
+  return grid
+
+
+def maze_layout(nb_rows, nb_cols, rng=None):
+  """Perfect maze carved by a randomized depth-first search over the odd cells of the grid."""
+  rng = rng or np.random
+  grid = np.full((nb_rows, nb_cols), 'X')
+  cells_rows, cells_cols = (nb_rows - 1) // 2, (nb_cols - 1) // 2
+  visited = np.zeros((cells_rows, cells_cols), dtype=bool)
+  moves = [(-1, 0), (0, 1), (1, 0), (0, -1)]
+
+  stack = [(cells_rows - 1, 0)]
+  visited[stack[0]] = True
+  grid[2 * stack[0][0] + 1, 1] = '.'
+  while stack:
+    i, j = stack[-1]
+    neighbours = [(i + di, j + dj) for di, dj in moves
+                  if 0 <= i + di < cells_rows and 0 <= j + dj < cells_cols and not visited[i + di, j + dj]]
+    if not neighbours:
+      stack.pop()
+      continue
+    ni, nj = neighbours[rng.randint(len(neighbours))]
+    visited[ni, nj] = True
+    grid[i + ni + 1, j + nj + 1] = '.'
+    grid[2 * ni + 1, 2 * nj + 1] = '.'
+    stack.append((ni, nj))
+
+  grid[2 * cells_rows - 1, 1] = 'S'
+  grid[1, 2 * cells_cols - 1] = 'G'
+  return grid
+
+
+def write_mdp(grid, save_path):
+  nb_rows, nb_cols = grid.shape
+  with open(save_path, "w") as f:
+    f.write("{},{}\n".format(nb_rows, nb_cols))
+    f.write("\n".join("".join(row) for row in grid))
+
+
+def generate_map(kind, nb_rows, nb_cols, save_path, nb_rooms=4, seed=0):
+  """Writes a rooms or maze layout of the given size to save_path and returns the path."""
+  rng = np.random.RandomState(seed)
+  if kind == "rooms":
+    grid = rooms_layout(nb_rows, nb_cols, nb_rooms, rng)
+  elif kind == "maze":
+    grid = maze_layout(nb_rows, nb_cols, rng)
+  else:
+    raise ValueError("Unknown layout {}".format(kind))
+  save_dir = os.path.dirname(save_path)
+  if save_dir and not os.path.exists(save_dir):
+    os.makedirs(save_dir)
+  write_mdp(grid, save_path)
+  return save_path
+
+
+if __name__ == '__main__':
+  # python -m env_wrappers.map_generator --kind maze --size 51 ./mdps/maze_51.mdp
+  parser = argparse.ArgumentParser()
+  parser.add_argument('save_path')
+  parser.add_argument('--kind', default="rooms", choices=["rooms", "maze"])
+  parser.add_argument('--size', type=int, default=13)
+  parser.add_argument('--nb_rooms', type=int, default=4)
+  parser.add_argument('--seed', type=int, default=0)
+  args = parser.parse_args()
+  print(generate_map(args.kind, args.size, args.size, args.save_path, args.nb_rooms, args.seed))
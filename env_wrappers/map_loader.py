@@ -0,0 +1,93 @@
+"""Loading of .mdp maps through a compiled .npz format and a process-wide cache."""
+
+import collections
+import os
+import sys
+import threading
+
+import numpy as np
+
+# walls: (nb_rows, nb_cols) boolean mask. start and goal: (x, y) cells, (-1, -1) when the map does not define them.
+# free_cells: indices (x * nb_cols + y) of all the cells that are not walls.
+CompiledMap = collections.namedtuple('CompiledMap', ['walls', 'start', 'goal', 'free_cells'])
+
+_cache = {}
+_cache_lock = threading.Lock()
+
+
+def parse_mdp(load_path):
+  """Parses the text format: a "rows,cols" header followed by one line per row where 'X' is a wall, 'S' the start,
+  '.' a free cell and any other character the goal. Anything after the last row is ignored."""
+  with open(load_path, "r") as f:
+    lines = f.readlines()
+  nb_rows, nb_cols = [int(v) for v in lines[0].split(',')]
+  cells = ''.join(line[:nb_cols] for line in lines[1:nb_rows + 1])
+  cells = np.frombuffer(cells.encode('ascii'), dtype='S1').reshape(nb_rows, nb_cols)
+
+  walls = cells == b'X'
+  starts = np.argwhere(cells == b'S')
+  goals = np.argwhere(~walls & (cells != b'.') & (cells != b'S'))
+  start = tuple(starts[-1]) if len(starts) else (-1, -1)
+  goal = tuple(goals[-1]) if len(goals) else (-1, -1)
+
+  return _make_map(walls, start, goal)
+
+
+def _make_map(walls, start, goal):
+  walls = np.asarray(walls, dtype=bool)
+  free_cells = np.flatnonzero(~walls).astype(np.int32)
+  walls.flags.writeable = False
+  free_cells.flags.writeable = False
+  return CompiledMap(walls, (int(start[0]), int(start[1])), (int(goal[0]), int(goal[1])), free_cells)
+
+
+def compiled_path(load_path):
+  return os.path.splitext(load_path)[0] + '.npz'
+
+
+def save_map(compiled_map, save_path):
+  np.savez(save_path, walls=compiled_map.walls, start=np.asarray(compiled_map.start),
+           goal=np.asarray(compiled_map.goal), free_cells=compiled_map.free_cells)
+
+
+def compile_map(load_path, save_path=None):
+  """Parses a .mdp file and writes its compiled .npz next to it (or to save_path)."""
+  save_path = save_path or compiled_path(load_path)
+  compiled_map = parse_mdp(load_path)
+  save_map(compiled_map, save_path)
+  return save_path
+
+
+def _load_compiled(load_path):
+  with np.load(load_path) as data:
+    return _make_map(data['walls'], data['start'], data['goal'])
+
+
+def load_map(load_path):
+  """Returns the CompiledMap of a .mdp or .npz file.
+
+  A .mdp file is read from its compiled .npz when that is at least as recent as the text file. Parsed maps are cached
+  per process, keyed by path and modification time, so all the workers of a run share a single read-only copy.
+  """
+  load_path = os.path.abspath(load_path)
+  key = (load_path, os.path.getmtime(load_path))
+  with _cache_lock:
+    if key in _cache:
+      return _cache[key]
+
+    npz_path = compiled_path(load_path)
+    if load_path.endswith('.npz'):
+      compiled_map = _load_compiled(load_path)
+    elif os.path.exists(npz_path) and os.path.getmtime(npz_path) >= key[1]:
+      compiled_map = _load_compiled(npz_path)
+    else:
+      compiled_map = parse_mdp(load_path)
+    _cache[key] = compiled_map
+
+  return compiled_map
+
+
+if __name__ == '__main__':
+  # python -m env_wrappers.map_loader mdps/*.mdp
+  for path in sys.argv[1:]:
+    print("Compiled {} to {}".format(path, compile_map(path)))
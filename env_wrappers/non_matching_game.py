@@ -1,12 +1,11 @@
+import collections
 import numpy as np
 import random
 import itertools
 import scipy.ndimage
 import scipy.misc
 import time
-import tkinter
 from PIL import Image
-from PIL import ImageTk
 import numpy as np
 from PIL import Image
 from gym import spaces
@@ -21,8 +20,16 @@ class gameOb():
         self.name = name
 
 class Gridworld_NonMatching():
+  # Direction of each action for the 4 orientations of the agent: 0 - up, 1 - down, 2 - left, 3 - right
+  rotations = [[0, 1, 2, 3],
+               [1, 0, 3, 2],
+               [3, 2, 0, 1],
+               [2, 3, 1, 0]]
+  # Number of the last headless frames kept by render(), older ones are dropped.
+  max_frames = 100
+
   def __init__(self, partial=False, size=5, nb_apples=1, nb_oranges=1, orange_reward=0, seed=42, deterministic=True,
-               internal_render=False):
+               internal_render=False, headless=False):
     self.action_space = spaces.Discrete(4)
     self.observation_space = spaces.Box(low=0,
                                         high=255,
@@ -43,7 +50,22 @@ class Gridworld_NonMatching():
     self.seed = seed
     self.first_room = True
 
-    # if internal_render:
+    # The tkinter window is created lazily by render(). Headless environments record the last max_frames
+    # rendered frames offscreen instead.
+    self.headless = headless
+    self.win = None
+    self.frames = collections.deque(maxlen=self.max_frames)
+    self.old_screen_label = None
+
+    self.build_canvas()
+    if seed:
+      np.random.seed(self.seed)
+    a = self.reset()
+    # plt.imshow(a_big, interpolation="nearest")
+
+  def create_window(self):
+    import tkinter
+
     self.win = tkinter.Toplevel()
 
     screen_width = self.win.winfo_screenwidth()
@@ -56,16 +78,23 @@ class Gridworld_NonMatching():
     self.win.geometry('%sx%s+%s+%s' % (512, 512, x, y))
     self.win.title("Gridworld")
     # self.win.bind("<Button>", button_click_exit_mainloop)
-    self.old_screen_label = None
-
-    if seed:
-      np.random.seed(self.seed)
-    a = self.reset()
-    # plt.imshow(a_big, interpolation="nearest")
 
   def get_screen(self):
-    state, state_big = self.renderEnv()
-    return state_big
+    return scipy.misc.imresize(self.renderEnv(), [200, 200, 3], interp='nearest')
+
+  def build_canvas(self):
+    """Preallocates the screen. On each step only the cells whose object changed are redrawn."""
+    self.padding = 2 if self.partial else 0
+    padding = self.padding
+    background = np.ones([self.sizeY + (padding * 2), self.sizeX + (padding * 2), 3])
+    background[padding:padding + self.sizeY, padding:padding + self.sizeX, :] = np.dstack([self.bg, self.bg, self.bg])
+    self.background = np.asarray(background, dtype=np.uint8)
+    self.canvas = self.background.copy()
+    # Color drawn over the background at each (x, y, size) object cell
+    self.drawn_cells = {}
+
+  def update_block_positions(self):
+    self.block_positions = set((ob.x, ob.y) for ob in self.objects if ob.name == 'block')
 
   def set_seed(self, seed):
     self.seed = seed
@@ -104,7 +133,8 @@ class Gridworld_NonMatching():
     else:
       obj = gameOb(self.newPosition(0), 1, self.orange_color, 0, 'orange')
     self.objects.append(obj)
-    state, s_big = self.renderEnv()
+    self.update_block_positions()
+    state = self.renderEnv()
     self.state = state
 
     # for ob in self.objects:
@@ -119,51 +149,19 @@ class Gridworld_NonMatching():
   def moveChar(self, action):
     # 0 - up, 1 - down, 2 - left, 3 - right, 4 - 90 counter-clockwise, 5 - 90 clockwise
     hero = self.objects[0]
-    blockPositions = [[-1, -1]]
-    for ob in self.objects:
-      if ob.name == 'block': blockPositions.append([ob.x, ob.y])
-    blockPositions = np.array(blockPositions)
     heroX = hero.x
     heroY = hero.y
     penalize = 0.
     if action < 4:
-      if self.orientation == 0:
-        direction = action
-      if self.orientation == 1:
-        if action == 0:
-          direction = 1
-        elif action == 1:
-          direction = 0
-        elif action == 2:
-          direction = 3
-        elif action == 3:
-          direction = 2
-      if self.orientation == 2:
-        if action == 0:
-          direction = 3
-        elif action == 1:
-          direction = 2
-        elif action == 2:
-          direction = 0
-        elif action == 3:
-          direction = 1
-      if self.orientation == 3:
-        if action == 0:
-          direction = 2
-        elif action == 1:
-          direction = 3
-        elif action == 2:
-          direction = 1
-        elif action == 3:
-          direction = 0
-
-      if direction == 0 and hero.y >= 1 and [hero.x, hero.y - 1] not in blockPositions.tolist():
+      direction = self.rotations[self.orientation][action]
+
+      if direction == 0 and hero.y >= 1 and (hero.x, hero.y - 1) not in self.block_positions:
         hero.y -= 1
-      if direction == 1 and hero.y <= self.sizeY - 2 and [hero.x, hero.y + 1] not in blockPositions.tolist():
+      if direction == 1 and hero.y <= self.sizeY - 2 and (hero.x, hero.y + 1) not in self.block_positions:
         hero.y += 1
-      if direction == 2 and hero.x >= 1 and [hero.x - 1, hero.y] not in blockPositions.tolist():
+      if direction == 2 and hero.x >= 1 and (hero.x - 1, hero.y) not in self.block_positions:
         hero.x -= 1
-      if direction == 3 and hero.x <= self.sizeX - 2 and [hero.x + 1, hero.y] not in blockPositions.tolist():
+      if direction == 3 and hero.x <= self.sizeX - 2 and (hero.x + 1, hero.y) not in self.block_positions:
         hero.x += 1
     if hero.x == heroX and hero.y == heroY:
       penalize = 0.0
@@ -198,6 +196,7 @@ class Gridworld_NonMatching():
             self.objects.append(apple)
             orange = gameOb(self.newPosition(0), 1, self.orange_color, -reward, 'orange')
             self.objects.append(orange)
+            self.update_block_positions()
             self.first_room = False
             return 0.1, False
           else:
@@ -207,10 +206,12 @@ class Gridworld_NonMatching():
             else:
               obj = gameOb(self.newPosition(0), 1, self.orange_color, 0, 'orange')
             self.objects.append(obj)
+            self.update_block_positions()
 
             return 0, False
         else:
           self.objects.remove(fruit)
+          self.update_block_positions()
           return fruit.reward, True
     return 0.0, False
 
@@ -222,8 +223,16 @@ class Gridworld_NonMatching():
     #
     # screen = Image.fromarray(state*255)
     # screen = screen.resize((512, 512))
-    screen = Image.fromarray(scipy.misc.imresize(state*255, [512, 512, 4], interp='nearest'))
+    screen = scipy.misc.imresize(state*255, [512, 512, 4], interp='nearest')
+    if self.headless:
+      self.frames.append(screen)
+      return
+    if self.win is None:
+      self.create_window()
+    from PIL import ImageTk
+    import tkinter
 
+    screen = Image.fromarray(screen)
 
     tkpi = ImageTk.PhotoImage(screen)
     label_img = tkinter.Label(self.win, image=tkpi)
@@ -240,33 +249,27 @@ class Gridworld_NonMatching():
     # plt.imshow(state_big)
 
   def renderEnv(self):
-    if self.partial == True:
-      padding = 2
-      a = np.ones([self.sizeY + (padding * 2), self.sizeX + (padding * 2), 3])
-      a[padding:-padding, padding:-padding, :] = 0
-      a[padding:-padding, padding:-padding, :] += np.dstack([self.bg, self.bg, self.bg])
-    else:
-      a = np.zeros([self.sizeY, self.sizeX, 3])
-      padding = 0
-      a += np.dstack([self.bg, self.bg, self.bg])
-    try:
-      hero = self.objects[0]
-    except:
-      print("fsf")
+    padding = self.padding
+    cells = {}
     for item in self.objects:
-      a[item.y + padding:item.y + item.size + padding, item.x + padding:item.x + item.size + padding,
-      :] = item.color
-      # if item.name == 'hero':
-      #    hero = item
+      cells[(item.x, item.y, item.size)] = item.color
+    for (x, y, size), color in list(self.drawn_cells.items()) + list(cells.items()):
+      if self.drawn_cells.get((x, y, size)) == cells.get((x, y, size)):
+        continue
+      cell = (slice(y + padding, y + size + padding), slice(x + padding, x + size + padding))
+      self.canvas[cell] = self.background[cell] if (x, y, size) not in cells else cells[(x, y, size)]
+    self.drawn_cells = cells
+
+    a = self.canvas
     if self.partial == True:
+      hero = self.objects[0]
       a = a[(hero.y):(hero.y + (padding * 2) + hero.size), (hero.x):(hero.x + (padding * 2) + hero.size), :]
-    a_big = scipy.misc.imresize(a, [200, 200, 3], interp='nearest')
-    return np.asarray(a, dtype=np.uint8), a_big
+    return a.copy()
 
   def step(self, action):
     penalty = self.moveChar(action)
     reward, done = self.checkGoal()
-    state, s_big = self.renderEnv()
+    state = self.renderEnv()
 
     # for ob in self.objects:
     #     if ob.name == 'apple':
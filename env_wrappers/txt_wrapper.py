@@ -1,7 +1,6 @@
+import collections
 import scipy.ndimage
-import tkinter
 from PIL import Image
-from PIL import ImageTk
 import numpy as np
 from PIL import Image
 import scipy.ndimage
@@ -9,11 +8,26 @@ import numpy as np
 import random
 from gym import spaces
 
+from .map_loader import load_map
+
 class GridWorld:
-  def __init__(self, goal_locations, load_path=None):
+  # Colors of the agent and of the goal after the screen is rescaled to [-1, 1].
+  agent_color = np.array([-1., 1., -1.], dtype=np.float32)
+  goal_color = np.array([1., -1., -1.], dtype=np.float32)
+  # Observation tables bigger than this are not cached and screens are built one at a time from the background.
+  max_observation_table_bytes = 512 * 1024 * 1024
+  # Number of observations per forward pass when the network features of all the states are cached.
+  feature_batch_size = 1024
+  # Number of the last headless frames kept by render(), older ones are dropped.
+  max_frames = 100
+
+  def __init__(self, goal_locations, load_path=None, headless=False):
     self.action_space = spaces.Discrete(4)
 
     self.rewardFunction = None
+    self.network = None
+    self.sess = None
+    self.feature_table = None
     self.nb_actions = 4
     if load_path != None:
       self.read_file(load_path)
@@ -25,6 +39,18 @@ class GridWorld:
     self.agentX, self.agentY = self.startX, self.startY
     self.nb_states = self.nb_rows * self.nb_cols
 
+    self.h = self.MDP.shape[0] * 42
+    self.w = self.MDP.shape[1] * 42
+    # The render backend is only created on the first call to render(). In headless mode the frames are
+    # recorded offscreen instead of being drawn in a tkinter window, so no display is needed. Only the last
+    # max_frames of them are kept.
+    self.headless = headless
+    self.win = None
+    self.frames = collections.deque(maxlen=self.max_frames)
+
+  def create_window(self):
+    import tkinter
+
     self.win = tkinter.Toplevel()
 
     screen_width = self.win.winfo_screenwidth()
@@ -33,8 +59,6 @@ class GridWorld:
     # calculate position x and y coordinates
     x = screen_width + 100
     y = screen_height + 100
-    self.h = self.MDP.shape[0] * 42
-    self.w = self.MDP.shape[1] * 42
     self.win.geometry('%sx%s+%s+%s' % (self.w, self.h, x, y))
     self.win.title("Gridworld")
 
@@ -45,11 +69,76 @@ class GridWorld:
     goal_pair = self.goal_locations[int(episode_nb / goal_change)]
     self.goalX = goal_pair[0]
     self.goalY = goal_pair[1]
+    self.build_goal_tables()
+
+  def build_transition_table(self):
+    """Compiles the map into a (nb_states, nb_actions) table of next state indices. Moves into walls or off
+    the grid, as well as any move from a wall cell, leave the agent where it is."""
+    idx = np.arange(self.nb_states)
+    x, y = idx // self.nb_cols, idx % self.nb_cols
+    walls = (self.MDP == -1)
+    # up, right, down, left
+    moves = [(-1, 0), (0, 1), (1, 0), (0, -1)]
+    self.next_state_table = np.empty((self.nb_states, self.nb_actions), dtype=np.int32)
+    for a, (dx, dy) in enumerate(moves):
+      nextX = np.clip(x + dx, 0, self.nb_rows - 1)
+      nextY = np.clip(y + dy, 0, self.nb_cols - 1)
+      can_move = ~walls[x, y] & ~walls[nextX, nextY]
+      self.next_state_table[:, a] = np.where(can_move, nextX * self.nb_cols + nextY, idx)
+
+  def build_goal_tables(self):
+    """Rebuilds the reward and terminal tables for the current goal and reward function. Rewards coming from
+    the network are the cosine similarity between the feature difference of a transition and the reward direction."""
+    goal_idx = self.get_state_index(self.goalX, self.goalY)
+    self.terminal_table = self.next_state_table == goal_idx
+    if self.rewardFunction is None:
+      self.reward_table = self.terminal_table.astype(np.float32)
+    elif self.has_network_reward():
+      fi = self.get_features()
+      fi_diff = fi[self.next_state_table] - fi[:, None]
+      fi_diff /= np.linalg.norm(fi_diff, axis=-1, keepdims=True) + 1e-8
+      self.reward_table = np.dot(fi_diff, self.rewardFunction)
+    else:
+      reward_function = np.asarray(self.rewardFunction)
+      self.reward_table = reward_function[self.next_state_table] - reward_function[:, None]
+
+  def build_feature_table(self):
+    """Caches the network features of every state for the current goal, running the network in batches of
+    feature_batch_size observations instead of once per state."""
+    self.feature_goal = (self.goalX, self.goalY)
+    features = []
+    for start in range(0, self.nb_states, self.feature_batch_size):
+      observations = self.get_observations(np.arange(start, min(start + self.feature_batch_size, self.nb_states)))
+      features.append(self.sess.run(self.network.fi, feed_dict={self.network.observation: observations}))
+    self.feature_table = np.concatenate(features)
+    self.feature_table.flags.writeable = False
+
+  def get_features(self):
+    if self.feature_table is None or self.feature_goal != (self.goalX, self.goalY):
+      self.build_feature_table()
+    return self.feature_table
+
+  def refresh_features(self):
+    """Drops the cached features. Call it after the weights of the network have been updated."""
+    self.feature_table = None
+    self.build_goal_tables()
+
+  def has_network_reward(self):
+    return self.rewardFunction is not None and len(self.rewardFunction) != self.nb_states and \
+           self.network is not None and self.sess is not None
 
   def render(self, s):
     # time.sleep(0.1)
     # s = self.pix_state
     screen = scipy.misc.imresize(s, [self.h, self.w,  3], interp='nearest')
+    if self.headless:
+      self.frames.append(screen)
+      return
+    if self.win is None:
+      self.create_window()
+    from PIL import ImageTk
+    import tkinter
+
     screen = Image.fromarray(screen, 'RGB')
     # screen = screen.resize((self.w, self.h))
     # screen_width = self.win.winfo_screenwidth()
@@ -68,20 +157,79 @@ class GridWorld:
     self.win.update_idletasks()
     self.win.update()
 
+  def build_background(self):
+    """Screen of the empty map: walls are 1 and free cells -1 on all 3 channels."""
+    background = np.where(self.MDP == -1, 1., -1.).astype(np.float32)
+    self.background = np.tile(background[..., None], [1, 1, 3])
+    self.observation_table = None
+    self.free_observations_goal = None
+
+  def build_observation_table(self):
+    """Precomputes the (nb_states, nb_rows, nb_cols, 3) observations of every agent position for the current
+    goal. The table is read-only, so the screens handed out by step and reset are views into it."""
+    self.observation_table = None
+    self.observation_goal = (self.goalX, self.goalY)
+    if self.nb_states * self.background.nbytes > self.max_observation_table_bytes:
+      return
+    idx = np.arange(self.nb_states)
+    observations = np.tile(self.background[None], [self.nb_states, 1, 1, 1])
+    observations[idx, idx // self.nb_cols, idx % self.nb_cols] = self.agent_color
+    observations[:, self.goalX, self.goalY] = self.goal_color
+    observations.flags.writeable = False
+    self.observation_table = observations
+
+  def get_observation(self, idx):
+    if self.observation_goal != (self.goalX, self.goalY):
+      self.build_observation_table()
+    if self.observation_table is not None:
+      return self.observation_table[idx]
+
+    x, y = self.get_state_xy(idx)
+    screen = self.background.copy()
+    screen[x, y] = self.agent_color
+    screen[self.goalX, self.goalY] = self.goal_color
+    return screen
+
+  def get_observations(self, indices):
+    if self.observation_goal != (self.goalX, self.goalY):
+      self.build_observation_table()
+    if self.observation_table is not None:
+      return self.observation_table[indices]
+
+    indices = np.asarray(indices)
+    screens = np.tile(self.background[None], [len(indices), 1, 1, 1])
+    screens[np.arange(len(indices)), indices // self.nb_cols, indices % self.nb_cols] = self.agent_color
+    screens[:, self.goalX, self.goalY] = self.goal_color
+    return screens
+
+  def get_free_observations(self):
+    """Indices and observations of all the cells that are not walls, cached for the current goal."""
+    if self.free_observations_goal != (self.goalX, self.goalY):
+      self.free_observations = self.get_observations(self.free_states)
+      self.free_observations_goal = (self.goalX, self.goalY)
+    return self.free_states, self.free_observations
+
+  def get_goal_observations(self, indices, goal_indices):
+    """Observations of the agent in the cells indices with the goal in the cells goal_indices, for any goals."""
+    indices, goal_indices = np.asarray(indices), np.asarray(goal_indices)
+    batch = np.arange(len(indices))
+    screens = np.tile(self.background[None], [len(indices), 1, 1, 1])
+    screens[batch, indices // self.nb_cols, indices % self.nb_cols] = self.agent_color
+    screens[batch, goal_indices // self.nb_cols, goal_indices % self.nb_cols] = self.goal_color
+    return screens
+
+  def encode_observations(self, observations):
+    """Inverse of get_goal_observations: the agent and goal cells of a batch of screens. The goal is drawn over the
+    agent, so a screen without an agent pixel has the agent on the goal."""
+    observations = np.asarray(observations).reshape(len(observations), self.nb_states, 3)
+    goal_indices = np.all(observations == self.goal_color, axis=2).argmax(axis=1)
+    agent = np.all(observations == self.agent_color, axis=2)
+    indices = np.where(agent.any(axis=1), agent.argmax(axis=1), goal_indices)
+    return indices, goal_indices
+
   def build_screen(self):
-    mdp_screen = np.array(self.MDP)
-    mdp_screen = np.expand_dims(mdp_screen, 2)
-    mdp_screen[mdp_screen == -1] = 255
-    mdp_screen = np.tile(mdp_screen, [1, 1, 3])
-    mdp_screen[self.agentX, self.agentY] = [0, 255, 0]
-    mdp_screen[self.goalX, self.goalY] = [255, 0, 0]
-    self.pix_state = mdp_screen
-    self.pix_state /= 255.
-    self.pix_state -= 0.5
-    self.pix_state *= 2.
-    # self.pix_state = scipy.misc.imresize(mdp_screen, [200, 200, 3], interp='nearest')
+    self.pix_state = self.get_observation(self.get_state_index(self.agentX, self.agentY))
     return self.pix_state
-    # return mdp_screen
 
   def reset(self):
     s = self.get_initial_state()
@@ -90,26 +238,20 @@ class GridWorld:
     return screen
 
   def read_file(self, load_path):
-    with open(load_path, "r") as f:
-      lines = f.readlines()
-    self.nb_rows, self.nb_cols = lines[0].split(',')
-    self.nb_rows, self.nb_cols = int(self.nb_rows), int(self.nb_cols)
-    self.MDP = np.zeros((self.nb_rows, self.nb_cols))
-    lines = lines[1:]
-    for i in range(self.nb_rows):
-      for j in range(self.nb_cols):
-        if lines[i][j] == '.':
-          self.MDP[i][j] = 0
-        elif lines[i][j] == 'X':
-          self.MDP[i][j] = -1
-        elif lines[i][j] == 'S':
-          self.MDP[i][j] = 0
-          self.startX = i
-          self.startY = j
-        else:  # 'G'
-          self.MDP[i][j] = 0
-          self.goalX = i
-          self.goalY = j
+    grid_map = load_map(load_path)
+    self.nb_rows, self.nb_cols = grid_map.walls.shape
+    self.nb_states = self.nb_rows * self.nb_cols
+    self.MDP = np.where(grid_map.walls, -1., 0.)
+    self.free_states = grid_map.free_cells
+    if grid_map.start[0] >= 0:
+      self.startX, self.startY = grid_map.start
+    if grid_map.goal[0] >= 0:
+      self.goalX, self.goalY = grid_map.goal
+
+    self.build_transition_table()
+    self.build_goal_tables()
+    self.build_background()
+    self.observation_goal = None
 
   def get_state_index(self, x, y):
     idx = y + x * self.nb_cols
@@ -142,28 +284,14 @@ class GridWorld:
     goal_indx = self.get_state_index(goalX, goalY)
     self.goalX = goalX
     self.goalY = goalY
+    self.build_goal_tables()
 
   def get_next_state(self, a):
-    action = ["up", "right", "down", "left", 'terminate']
-    nextX, nextY = self.agentX, self.agentY
-
-    if action[a] == 'terminate':
+    if a >= self.nb_actions:  # terminate
       return -1, -1
 
-    if self.MDP[self.agentX][self.agentY] != -1:
-      if action[a] == 'up' and self.agentX > 0:
-        nextX, nextY = self.agentX - 1, self.agentY
-      elif action[a] == 'right' and self.agentY < self.nb_cols - 1:
-        nextX, nextY = self.agentX, self.agentY + 1
-      elif action[a] == 'down' and self.agentX < self.nb_rows - 1:
-        nextX, nextY = self.agentX + 1, self.agentY
-      elif action[a] == 'left' and self.agentY > 0:
-        nextX, nextY = self.agentX, self.agentY - 1
-
-    if self.MDP[nextX][nextY] != -1:
-      return nextX, nextY
-    else:
-      return self.agentX, self.agentY
+    currStateIdx = self.get_state_index(self.agentX, self.agentY)
+    return self.get_state_xy(self.next_state_table[currStateIdx, a])
 
   def special_get_next_state(self, a, orig_nextX, orig_nextY):
     action = ["up", "right", "down", "left", 'terminate']
@@ -195,34 +323,32 @@ class GridWorld:
       return False
 
   def get_next_reward(self, nextX, nextY):
+    currStateIdx = self.get_state_index(self.agentX, self.agentY)
+    nextStateIdx = self.get_state_index(nextX, nextY)
+
+    return self.get_transition_reward(currStateIdx, nextStateIdx)
+
+  def get_transition_reward(self, currStateIdx, nextStateIdx):
     if self.rewardFunction is None:
-      if nextX == self.goalX and nextY == self.goalY:
+      if nextStateIdx == self.get_state_index(self.goalX, self.goalY):
         reward = 1
       else:
         reward = 0
-    elif len(self.rewardFunction) != self.nb_states and self.network != None and self.sess != None:
-      currStateIdx = self.get_state_index(self.agentX, self.agentY)
-      s, _, _ = self.get_state(currStateIdx)
-      feed_dict = {self.network.observation: np.stack([s])}
-      fi = self.sess.run(self.network.fi,
-                    feed_dict=feed_dict)[0]
-      nextStateIdx = self.get_state_index(nextX, nextY)
-      s1, _, _ = self.get_state(nextStateIdx)
-      feed_dict = {self.network.observation: np.stack([s1])}
-      fi1 = self.sess.run(self.network.fi,
-                         feed_dict=feed_dict)[0]
-      reward = self.cosine_similarity((fi1 - fi), self.rewardFunction)
-
-
+    elif self.has_network_reward():
+      fi = self.get_features()
+      reward = self.cosine_similarity((fi[nextStateIdx] - fi[currStateIdx]), self.rewardFunction)
     else:
-      currStateIdx = self.get_state_index(self.agentX, self.agentY)
-      nextStateIdx = self.get_state_index(nextX, nextY)
-
       reward = self.rewardFunction[nextStateIdx] \
                - self.rewardFunction[currStateIdx]
 
     return reward
 
+  def get_reward(self, currStateIdx, a):
+    if self.reward_table is not None:
+      return self.reward_table[currStateIdx, a]
+
+    return self.get_transition_reward(currStateIdx, self.next_state_table[currStateIdx, a])
+
   def cosine_similarity(self, next_sf, evect):
     state_dif_norm = np.linalg.norm(next_sf)
     state_dif_normalized = next_sf / (state_dif_norm + 1e-8)
@@ -236,22 +362,16 @@ class GridWorld:
     return res
 
   def fake_get_state(self, idx):
-    orig_agentX, orig_agentY = self.agentX, self.agentY
     x, y = self.get_state_xy(idx)
-    self.agentX, self.agentY = x, y
 
-    screen = self.build_screen()
-    self.agentX, self.agentY = orig_agentX, orig_agentY
-
-    return screen, x, y
+    return self.get_observation(idx), x, y
 
   def get_state(self, idx):
+    """Moves the agent to state idx. Use fake_get_state to only read the observation of a state."""
     x, y = self.get_state_xy(idx)
     self.agentX, self.agentY = x, y
 
-    screen = self.build_screen()
-
-    return screen, x, y
+    return self.build_screen(), x, y
 
   def not_wall(self, i, j):
     if self.MDP[i][j] != -1:
@@ -269,22 +389,11 @@ class GridWorld:
     if currState == self.nb_states:
       return currState, 0
 
-    tmpx, tmpy = self.agentX, self.agentY
-    self.agentX, self.agentY = self.get_state_xy(currState)
-    nextX, nextY = self.agentX, self.agentY
-
-    nextStateIdx = None
-    reward = None
-
-    nextX, nextY = self.get_next_state(a)
-    if nextX != -1 and nextY != -1:  # If it is not the absorbing state:
-      reward = self.get_next_reward(nextX, nextY)
-      nextStateIdx = self.get_state_index(nextX, nextY)
-    else:
-      reward = 0
-      nextStateIdx = self.nb_states
+    if a >= self.nb_actions:  # terminate leads to the absorbing state
+      return self.nb_states, 0
 
-    self.agentX, self.agentY = tmpx, tmpy
+    nextStateIdx = int(self.next_state_table[currState, a])
+    reward = self.get_reward(currState, a)
 
     return nextStateIdx, reward
 
@@ -292,39 +401,33 @@ class GridWorld:
     return self.agentX, self.agentY
 
   def step(self, a):
-    nextX, nextY = self.get_next_state(a)
-
-    self.agentX, self.agentY = nextX, nextY
-
-    done = False
-    if self.is_terminal(nextX, nextY):
-      done = True
+    currStateIdx = self.get_state_index(self.agentX, self.agentY)
+    nextStateIdx = int(self.next_state_table[currStateIdx, a])
+    done = bool(self.terminal_table[currStateIdx, a])
+    reward = self.get_reward(currStateIdx, a)
 
-    reward = self.get_next_reward(nextX, nextY)
-    nextStateIdx = self.get_state_index(nextX, nextY)
+    self.agentX, self.agentY = self.get_state_xy(nextStateIdx)
 
     screen = self.build_screen()
 
     return screen, reward, done, nextStateIdx
 
   def fake_step(self, a):
-    orig_agentX, orig_agentY = self.agentX, self.agentY
-    nextX, nextY = self.get_next_state(a)
-
-    self.agentX, self.agentY = nextX, nextY
-
-    done = False
-    if self.is_terminal(nextX, nextY):
-      done = True
+    currStateIdx = self.get_state_index(self.agentX, self.agentY)
+    nextStateIdx, reward, done, screen = self.successors([currStateIdx], [a])
 
-    reward = self.get_next_reward(nextX, nextY)
-    nextStateIdx = self.get_state_index(nextX, nextY)
+    return screen[0], reward[0], bool(done[0]), int(nextStateIdx[0])
 
-    screen = self.build_screen()
-
-    self.agentX, self.agentY = orig_agentX, orig_agentY
+  def successors(self, state_indices, actions):
+    """Answers a batch of (state, primitive action) queries from the compiled tables without moving the agent.
+    Returns the next state indices, rewards, terminal flags and the observations of the next states."""
+    state_indices = np.asarray(state_indices, dtype=np.int32)
+    actions = np.asarray(actions, dtype=np.int32)
+    next_indices = self.next_state_table[state_indices, actions]
+    rewards = self.reward_table[state_indices, actions]
+    done = self.terminal_table[state_indices, actions]
 
-    return screen, reward, done, nextStateIdx
+    return next_indices, rewards, done, self.get_observations(next_indices)
 
   def special_step(self, a, last_state_idx):
     x, y = self.get_state_xy(last_state_idx)
@@ -348,12 +451,15 @@ class GridWorld:
 
   def define_reward_function(self, vector):
     self.rewardFunction = vector
+    self.build_goal_tables()
 
   def define_network(self, net):
     self.network = net
+    self.refresh_features()
 
   def define_session(self, sess):
     self.sess = sess
+    self.refresh_features()
 
 if __name__ == '__main__':
 
@@ -0,0 +1,71 @@
+import numpy as np
+from gym import spaces
+
+from .txt_wrapper import GridWorld
+
+
+class VecGridWorld:
+  """Steps nb_envs copies of the same GridWorld map at once.
+
+  Agent positions and goals are kept as arrays of state indices, so a step of all the instances is a single lookup in
+  the compiled transition table of the map. Instances that finish their episode are reset to the start state and the
+  observation returned for them is the first observation of the new episode.
+  """
+
+  def __init__(self, nb_envs, goal_locations, load_path, max_length=None):
+    self.grid = GridWorld(goal_locations, load_path, headless=True)
+    self.nb_envs = nb_envs
+    self.max_length = max_length
+    self.action_space = self.grid.action_space
+    self.observation_space = spaces.Box(low=0,
+                                        high=255,
+                                        shape=(nb_envs, self.grid.nb_rows, self.grid.nb_cols, 3))
+    self.nb_rows, self.nb_cols = self.grid.nb_rows, self.grid.nb_cols
+    self.nb_states = self.grid.nb_states
+    self.nb_actions = self.grid.nb_actions
+    self.goal_locations = goal_locations
+
+    self.start = self.grid.get_state_index(self.grid.startX, self.grid.startY)
+    self.goals = np.full(nb_envs, self.grid.get_state_index(self.grid.goalX, self.grid.goalY), dtype=np.int32)
+    self.states = np.full(nb_envs, self.start, dtype=np.int32)
+    self.lengths = np.zeros(nb_envs, dtype=np.int32)
+    self.envs_idx = np.arange(nb_envs)
+
+  def set_goal(self, episode_nb, goal_change, env_ids=None):
+    goal_pair = self.goal_locations[int(episode_nb / goal_change)]
+    self.set_goals(self.grid.get_state_index(goal_pair[0], goal_pair[1]), env_ids)
+
+  def set_goals(self, goal_indices, env_ids=None):
+    if env_ids is None:
+      env_ids = self.envs_idx
+    self.goals[env_ids] = goal_indices
+
+  def build_screens(self, states):
+    screens = np.tile(self.grid.background[None], [self.nb_envs, 1, 1, 1])
+    screens[self.envs_idx, states // self.nb_cols, states % self.nb_cols] = self.grid.agent_color
+    screens[self.envs_idx, self.goals // self.nb_cols, self.goals % self.nb_cols] = self.grid.goal_color
+    return screens
+
+  def reset(self):
+    self.states[:] = self.start
+    self.lengths[:] = 0
+    return self.build_screens(self.states)
+
+  def step(self, actions):
+    next_states = self.next_states(self.states, actions)
+    done = next_states == self.goals
+    reward = done.astype(np.float32)
+    self.lengths += 1
+    if self.max_length is not None:
+      done |= self.lengths >= self.max_length
+
+    self.states = np.where(done, self.start, next_states).astype(np.int32)
+    self.lengths[done] = 0
+
+    return self.build_screens(self.states), reward, done
+
+  def next_states(self, states, actions):
+    return self.grid.next_state_table[states, np.asarray(actions, dtype=np.int32)]
+
+  def get_action_set(self):
+    return self.grid.get_action_set()
@@ -4,9 +4,12 @@ from __future__ import print_function
 
 import tensorflow as tf
 import tensorflow.contrib.layers as layers
-from utility import gradient_summaries, huber_loss
+from utility import gradient_summaries, huber_loss, masked_mean
 import numpy as np
+import threading
 from agents.schedules import LinearSchedule, TFLinearSchedule
+from tools.ring_buffer import RingBuffer
+from tools.utils import sync_group
 import os
 
 class LinearSFNetwork():
@@ -349,11 +352,23 @@ class EignOCNetwork():
       self.config.lr, name='network_optimizer')
     if scope == 'global':
       self.sf_matrix_path = os.path.join(config.stage_logdir, "sf_matrix.npy")
+      # Published with publish_directions and read with get_directions only
+      self.directions_lock = threading.Lock()
+      self.directions_version = 0
       self.directions = np.zeros((config.nb_options, config.sf_layers[-1]))
+      self.directions.flags.writeable = False
+      # All the vectors of the last truncated SVD, used to warm-start the next one
+      self.eigen_basis = None
+      # One stripe per worker, written with add_SF and read with snapshot
+      self.sf_matrix_buffer = RingBuffer((self.config.sf_matrix_size or nb_states, self.config.sf_layers[-1]),
+                                         config.num_agents)
       if os.path.exists(self.sf_matrix_path):
-        self.sf_matrix_buffer = np.load(self.sf_matrix_path)
-      else:
-        self.sf_matrix_buffer = np.zeros(shape=(self.config.sf_matrix_size, self.config.sf_layers[-1]), dtype=np.float32)
+        self.sf_matrix_buffer.load(self.sf_matrix_path)
+      # StepCounters of the workers, synced before every checkpoint
+      self.step_counters = []
+      # Bumped after every gradient step on a group of parameters, so workers only copy the groups that changed
+      self.param_versions_lock = threading.Lock()
+      self.param_versions = {"aux": 0, "sf": 0, "option": 0}
 
     # self._exploration_options = TFLinearSchedule(self._config.explore_steps, self._config.final_random_action_prob,
     #                                              self._config.initial_random_action_prob)
@@ -498,8 +513,16 @@ class EignOCNetwork():
           shape=[None, config.input_size[0], config.input_size[1], config.history_size], dtype=tf.float32,
           name="target_next_obs")
         self.options_placeholder = tf.placeholder(shape=[None], dtype=tf.int32, name="options")
+        # 1 for the transitions of primitive options, which only train their critic
+        self.primitive_mask = tf.placeholder(shape=[None], dtype=tf.float32, name="primitive_mask")
+        option_mask = 1. - self.primitive_mask
         self.target_eigen_return = tf.placeholder(shape=[None], dtype=tf.float32)
         self.target_return = tf.placeholder(shape=[None], dtype=tf.float32)
+        self.prev_option = tf.placeholder(shape=[], dtype=tf.int32, name="prev_option")
+        self.new_option = tf.placeholder(shape=[], dtype=tf.bool, name="new_option")
+
+        self.step_option, self.step_primitive, self.step_action, self.step_term = \
+          self.get_step_decisions(self.prev_option, self.new_option)
 
         self.policies = self.get_intra_option_policies(self.options_placeholder)
         self.responsible_actions = self.get_responsible_actions(self.policies, self.actions_placeholder)
@@ -531,23 +554,26 @@ class EignOCNetwork():
         if self.config.eigen:
           with tf.name_scope('eigen_critic_loss'):
             eigen_td_error = self.target_eigen_return - eigen_q_val
-            self.eigen_critic_loss = tf.reduce_mean(0.5 * self.config.eigen_critic_coef * tf.square(eigen_td_error))
+            self.eigen_critic_loss = masked_mean(0.5 * self.config.eigen_critic_coef * tf.square(eigen_td_error),
+                                                 option_mask)
 
         with tf.name_scope('critic_loss'):
           td_error = self.target_return - q_val
-        self.critic_loss = tf.reduce_mean(0.5 * self.config.critic_coef * tf.square(td_error))
+        self.critic_loss = masked_mean(0.5 * self.config.critic_coef * tf.square(td_error), option_mask)
+        self.primitive_critic_loss = masked_mean(0.5 * self.config.critic_coef * tf.square(td_error),
+                                                 self.primitive_mask)
 
         with tf.name_scope('termination_loss'):
-          self.term_loss = tf.reduce_mean(
-            o_term * (tf.stop_gradient(q_val) - tf.stop_gradient(self.v) + 0.01))
+          self.term_loss = masked_mean(
+            o_term * (tf.stop_gradient(q_val) - tf.stop_gradient(self.v) + 0.01), option_mask)
 
         with tf.name_scope('entropy_loss'):
-          self.entropy_loss = -self.entropy_coef * tf.reduce_mean(tf.reduce_sum(self.policies *
-                                                                                tf.log(self.policies + 1e-7),
-                                                                                axis=1))
+          self.entropy_loss = -self.entropy_coef * masked_mean(tf.reduce_sum(self.policies *
+                                                                             tf.log(self.policies + 1e-7),
+                                                                             axis=1), option_mask)
         with tf.name_scope('policy_loss'):
-          self.policy_loss = -tf.reduce_mean(tf.log(self.responsible_actions + 1e-7) * tf.stop_gradient(
-            eigen_td_error if self.config.eigen else td_error))
+          self.policy_loss = -masked_mean(tf.log(self.responsible_actions + 1e-7) * tf.stop_gradient(
+            eigen_td_error if self.config.eigen else td_error), option_mask)
 
         self.option_loss = self.policy_loss - self.entropy_loss + self.critic_loss + self.term_loss
         if self.config.eigen:
@@ -558,7 +584,7 @@ class EignOCNetwork():
         gradients_sf = tf.gradients(self.sf_loss, local_vars)
         gradients_aux = tf.gradients(self.aux_loss, local_vars)
         gradients_option = tf.gradients(self.option_loss, local_vars)
-        gradients_primitive_option = tf.gradients(self.critic_loss, local_vars)
+        gradients_primitive_option = tf.gradients(self.primitive_critic_loss, local_vars)
 
         self.var_norms = tf.global_norm(local_vars)
         grads_sf, self.grad_norms_sf = tf.clip_by_global_norm(gradients_sf, self.config.gradient_clip_norm_value)
@@ -596,8 +622,38 @@ class EignOCNetwork():
         global_vars = tf.get_collection(tf.GraphKeys.TRAINABLE_VARIABLES, 'global')
         self.apply_grads_sf = self.network_optimizer.apply_gradients(zip(grads_sf, global_vars))
         self.apply_grads_aux = self.network_optimizer.apply_gradients(zip(grads_aux, global_vars))
-        self.apply_grads_option = self.network_optimizer.apply_gradients(zip(grads_option, global_vars))
-        self.apply_grads_primitive_option = self.network_optimizer.apply_gradients(zip(grads_primitive_option, global_vars))
+        # Both subsets are clipped separately, as when they were applied one after the other, then applied at once
+        grads_masked_option = [g if p is None else p if g is None else g + p
+                               for g, p in zip(grads_option, grads_primitive_option)]
+        self.apply_grads_option = self.network_optimizer.apply_gradients(zip(grads_masked_option, global_vars))
+        # Groups of global parameters each apply_grads_* op updates
+        self.updated_groups = {name: {sync_group(v) for g, v in zip(grads, global_vars) if g is not None}
+                               for name, grads in [("sf", grads_sf), ("aux", grads_aux), ("option", grads_masked_option)]}
+
+  def publish_directions(self, directions, eigen_basis=None):
+    """Atomically replaces the option directions by a read-only copy and returns their new version."""
+    directions = np.array(directions)
+    directions.flags.writeable = False
+    with self.directions_lock:
+      self.directions = directions
+      if eigen_basis is not None:
+        self.eigen_basis = eigen_basis
+      self.directions_version += 1
+      return self.directions_version
+
+  def bump_param_versions(self, groups):
+    with self.param_versions_lock:
+      for group in groups:
+        self.param_versions[group] += 1
+
+  def get_param_version(self, group):
+    with self.param_versions_lock:
+      return self.param_versions[group]
+
+  def get_directions(self):
+    """Consistent (version, directions, eigen_basis) of the last publication."""
+    with self.directions_lock:
+      return self.directions_version, self.directions, self.eigen_basis
 
   def get_intra_option_policies(self, options):
     options_taken_one_hot = tf.one_hot(options, self.nb_options, dtype=tf.float32, name="options_one_hot")
@@ -612,6 +668,20 @@ class EignOCNetwork():
     responsible_actions = tf.reduce_sum(policies * actions_onehot, [1])
     return responsible_actions
 
+  def get_step_decisions(self, prev_option, new_option):
+    """Option, primitive flag, action and termination sample at the last observation of the batch, so that acting
+    needs no session call of its own. The option is re-selected epsilon-greedily when new_option is set."""
+    last = tf.shape(self.observation)[0] - 1
+    option = tf.where(new_option, self.current_option[last], prev_option)
+    primitive = option >= self.nb_options
+    intra_option = tf.minimum(option, self.nb_options - 1)
+    pi = tf.gather(self.options[last], intra_option)
+    sampled_action = tf.cast(tf.multinomial(tf.log(pi[None] + 1e-7), 1)[0, 0], tf.int32)
+    action = tf.where(primitive, option - self.nb_options, sampled_action)
+    o_term = tf.logical_or(primitive,
+                           tf.gather(self.termination[last], intra_option) > tf.random_uniform(shape=[]))
+    return option, primitive, action, o_term
+
   def get_eigen_q(self, o):
     options_taken_one_hot = tf.one_hot(o, self.config.nb_options,
                                        name="options_one_hot")
@@ -0,0 +1,110 @@
+import math
+
+import numpy as np
+import pytest
+
+from auxilary.policy_iteration import PolicyIteration
+
+
+class OpenGrid():
+  """Grid without walls with the tables and the reward function interface of GridWorld."""
+
+  def __init__(self, nb_rows, nb_cols):
+    self.nb_states = nb_rows * nb_cols
+    self.nb_actions = 4
+    self.next_state_table = np.zeros((self.nb_states, self.nb_actions), dtype=np.int32)
+    for s in range(self.nb_states):
+      row, col = divmod(s, nb_cols)
+      moves = [(row - 1, col), (row, col + 1), (row + 1, col), (row, col - 1)]
+      for a, (r, c) in enumerate(moves):
+        inside = 0 <= r < nb_rows and 0 <= c < nb_cols
+        self.next_state_table[s, a] = r * nb_cols + c if inside else s
+    self.define_reward_function(np.zeros(self.nb_states))
+
+  def define_reward_function(self, vector):
+    vector = np.asarray(vector)
+    self.reward_table = vector[self.next_state_table] - vector[:, None]
+
+  def get_action_set(self):
+    return range(0, 4)
+
+  def get_next_state_and_reward(self, currState, a):
+    if currState == self.nb_states or a >= self.nb_actions:
+      return self.nb_states, 0
+    return int(self.next_state_table[currState, a]), self.reward_table[currState, a]
+
+
+def baseline_policy_iteration(env, gamma, augment, theta=0.001):
+  """The loop implementation PolicyIteration replaced, used as reference."""
+  nb_states = env.nb_states + 1
+  V = np.zeros(nb_states + 1)
+  pi = np.zeros(nb_states + 1, dtype=int)
+  actions = np.append(env.get_action_set(), [4]) if augment else env.get_action_set()
+  policy_stable = False
+  while not policy_stable:
+    delta = 1
+    while delta > theta:
+      delta = 0.
+      for s in range(nb_states):
+        v = V[s]
+        nextS, nextR = env.get_next_state_and_reward(s, pi[s])
+        V[s] = nextR + gamma * V[nextS]
+        delta = max(delta, math.fabs(v - V[s]))
+    policy_stable = True
+    for s in range(nb_states):
+      old_action = pi[s]
+      tempV = [0.] * len(actions)
+      for i in range(len(actions)):
+        nextS, nextR = env.get_next_state_and_reward(s, i)
+        tempV[i] = nextR + gamma * V[nextS]
+      pi[s] = np.argmax(tempV)
+      if math.fabs(tempV[pi[s]] - tempV[len(actions) - 1]) < 0.001:
+        pi[s] = len(actions) - 1
+      if old_action != pi[s]:
+        policy_stable = False
+  return V, pi
+
+
+def check_against_baseline(env, vectors):
+  for vector in vectors:
+    # As in the visualizer and the linear SF agent, the reward is defined after building the solver
+    polIter = PolicyIteration(0.9, env, augmentActionSet=True)
+    env.define_reward_function(vector)
+    V, pi = polIter.solvePolicyIteration()
+    baseline_V, baseline_pi = baseline_policy_iteration(env, 0.9, True)
+    np.testing.assert_array_equal(pi, baseline_pi)
+    np.testing.assert_allclose(V, baseline_V, atol=1e-2)
+
+
+def test_reward_defined_after_construction():
+  env = OpenGrid(6, 7)
+  rng = np.random.RandomState(0)
+  check_against_baseline(env, [rng.randn(env.nb_states) for _ in range(4)])
+
+
+def test_solver_reused_across_rewards():
+  env = OpenGrid(5, 5)
+  polIter = PolicyIteration(0.9, env, augmentActionSet=True)
+  rng = np.random.RandomState(1)
+  for _ in range(3):
+    env.define_reward_function(rng.randn(env.nb_states))
+    polIter.V = np.zeros(env.nb_states + 2)
+    polIter.pi = np.zeros(env.nb_states + 2, dtype=int)
+    V, pi = polIter.solvePolicyIteration()
+    baseline_V, baseline_pi = baseline_policy_iteration(env, 0.9, True)
+    np.testing.assert_array_equal(pi, baseline_pi)
+    np.testing.assert_allclose(V, baseline_V, atol=1e-2)
+
+
+def test_eigenoptions_of_4rooms():
+  pytest.importorskip("tensorflow")
+  from env_wrappers import GridWorld
+  env = GridWorld([(1, 11)], "./mdps/4rooms.mdp", headless=True)
+  adjacency = np.zeros((env.nb_states, env.nb_states))
+  for s in range(env.nb_states):
+    for a in range(env.nb_actions):
+      if env.next_state_table[s, a] != s:
+        adjacency[s, env.next_state_table[s, a]] = 1
+  eigenvalues, eigenvectors = np.linalg.eigh(np.diag(adjacency.sum(1)) - adjacency)
+  vectors = eigenvectors[:, eigenvalues > 1e-8][:, :4].T
+  check_against_baseline(env, list(vectors) + list(-vectors))
@@ -0,0 +1,63 @@
+"""Truncated, warm-started computation of the top right singular vectors of a SF matrix."""
+
+import numpy as np
+
+
+def top_right_singular_vectors(matrix, k, init=None, tol=1e-6, max_iters=200, patience=10, oversampling=4,
+                               rng=np.random):
+  """Top k singular values and right singular vectors of matrix (rows of V^T, by decreasing singular value).
+
+  Runs subspace iteration with Rayleigh-Ritz projection on the small (d, d) Gram matrix instead of decomposing the
+  whole (n, d) matrix. Rows of init warm-start the corresponding vectors; zero rows are started at random. When the
+  residual ||G v - lambda v|| / ||G|| has not improved for patience iterations, or max_iters is reached, it falls
+  back to a full SVD.
+
+  Returns singular_values, vectors and a dict with the number of iterations, the final residual and whether the
+  full SVD was used.
+  """
+  matrix = np.asarray(matrix, dtype=np.float64)
+  gram = np.dot(matrix.T, matrix)
+  d = gram.shape[0]
+  k = min(k, d)
+  nb_vectors = min(k + oversampling, d)
+
+  basis = rng.randn(d, nb_vectors)
+  if init is not None:
+    init = np.asarray(init, dtype=np.float64)[:k]
+    known = np.linalg.norm(init, axis=1) > 1e-8
+    basis[:, :len(init)][:, known] = init[known].T
+  basis, _ = np.linalg.qr(basis)
+
+  scale = np.linalg.norm(gram) + 1e-12
+  best_residual = np.inf
+  stalled = 0
+  residual = np.inf
+  for iteration in range(1, max_iters + 1):
+    basis, _ = np.linalg.qr(np.dot(gram, basis))
+    eigenvalues, rotation = np.linalg.eigh(np.dot(basis.T, np.dot(gram, basis)))
+    order = np.argsort(eigenvalues)[::-1]
+    eigenvalues, basis = eigenvalues[order], np.dot(basis, rotation[:, order])
+
+    residual = np.linalg.norm(np.dot(gram, basis[:, :k]) - basis[:, :k] * eigenvalues[:k]) / scale
+    if residual < tol:
+      break
+    if residual < best_residual * (1 - 1e-3):
+      best_residual, stalled = residual, 0
+    else:
+      stalled += 1
+    if stalled >= patience:
+      break
+
+  fallback = residual >= tol
+  if fallback:
+    _, singular_values, vt = np.linalg.svd(matrix, full_matrices=False)
+    singular_values, vectors = singular_values[:k], vt[:k]
+  else:
+    singular_values, vectors = np.sqrt(np.maximum(eigenvalues[:k], 0.)), basis[:, :k].T
+
+  # Singular vectors are defined up to their sign: keep the one closest to the warm start
+  if init is not None:
+    flip = np.sum(vectors[:len(init)] * init, axis=1) < 0
+    vectors[:len(init)][flip] *= -1
+
+  return singular_values, vectors, dict(iterations=iteration, residual=residual, fallback=fallback)
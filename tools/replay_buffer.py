@@ -0,0 +1,153 @@
+import copy
+import ctypes
+import multiprocessing
+import random
+
+import numpy as np
+
+class ReplayBuffer():
+  """Fixed capacity FIFO replay memory of transitions kept in preallocated, contiguous arrays (one per field).
+
+  The arrays are allocated from the shapes and dtypes of the first transition appended. Appending overwrites the oldest
+  transition once the buffer is full, and sampling gathers a minibatch with a single indexing per field.
+  """
+
+  def __init__(self, capacity):
+    self.capacity = int(capacity)
+    self.fields = None
+    self.index = 0
+    self.size = 0
+
+  def __len__(self):
+    return self.size
+
+  def append(self, *transition):
+    if self.fields is None:
+      self.fields = [np.zeros((self.capacity,) + np.shape(x), dtype=np.asarray(x).dtype) for x in transition]
+    for field, x in zip(self.fields, transition):
+      field[self.index] = x
+    self.index = (self.index + 1) % self.capacity
+    self.size = min(self.size + 1, self.capacity)
+
+  def sample(self, batch_size):
+    """batch_size distinct transitions drawn uniformly, as one (batch_size, ...) array per field."""
+    indices = np.array(random.sample(range(self.size), batch_size))
+    return [field[indices] for field in self.fields]
+
+
+class SharedReplayBuffer():
+  """Fixed capacity replay memory shared by all the worker threads, and by other processes, through shared memory.
+
+  Each field lives in a multiprocessing.RawArray of shape (capacity,) + field_shape. The rows are split into
+  nb_stripes stripes with their own cursor and lock: a writer appends FIFO to the stripe of its writer_id (see view),
+  so writers with different ids never contend, while sampling draws from every stripe. The buffer can be handed to a
+  multiprocessing.Process, which then reads and writes the same memory.
+  """
+
+  def __init__(self, capacity, fields, nb_stripes=1):
+    """fields: one (shape, dtype) pair per element of a transition."""
+    self.capacity = int(capacity)
+    self.specs = [(tuple(shape), np.dtype(dtype).str) for shape, dtype in fields]
+    nb_stripes = max(1, min(nb_stripes, self.capacity))
+    self.bounds = np.linspace(0, self.capacity, nb_stripes + 1).astype(int).tolist()
+    self.raw_fields = [multiprocessing.RawArray(ctypes.c_byte,
+                                                self.capacity * int(np.prod(shape)) * np.dtype(dtype).itemsize)
+                       for shape, dtype in self.specs]
+    self.cursors = multiprocessing.RawArray(ctypes.c_long, nb_stripes)
+    self.counts = multiprocessing.RawArray(ctypes.c_long, nb_stripes)
+    self.locks = [multiprocessing.Lock() for _ in range(nb_stripes)]
+    self.writer_id = 0
+    self._build_views()
+
+  def _build_views(self):
+    self.fields = [np.frombuffer(raw, dtype=dtype).reshape((self.capacity,) + shape)
+                   for raw, (shape, dtype) in zip(self.raw_fields, self.specs)]
+
+  def __getstate__(self):
+    state = self.__dict__.copy()
+    del state["fields"]
+    return state
+
+  def __setstate__(self, state):
+    self.__dict__.update(state)
+    self._build_views()
+
+  def view(self, writer_id):
+    """The same memory, appending to the stripe of writer_id."""
+    buffer = copy.copy(self)
+    buffer.writer_id = writer_id
+    return buffer
+
+  def __len__(self):
+    return sum(self.counts)
+
+  def append(self, *transition):
+    stripe = self.writer_id % len(self.locks)
+    start, stripe_size = self.bounds[stripe], self.bounds[stripe + 1] - self.bounds[stripe]
+    with self.locks[stripe]:
+      for field, x in zip(self.fields, transition):
+        field[start + self.cursors[stripe]] = x
+      self.cursors[stripe] = (self.cursors[stripe] + 1) % stripe_size
+      self.counts[stripe] = min(self.counts[stripe] + 1, stripe_size)
+
+  def sample(self, batch_size):
+    """batch_size distinct transitions drawn uniformly over all the stripes, as one (batch_size, ...) array per
+    field. The stripes sampled from are locked while their rows are gathered."""
+    counts = np.array(self.counts[:])
+    offsets = np.cumsum(counts)
+    ranks = np.array(random.sample(range(int(offsets[-1])), batch_size))
+    stripes = np.searchsorted(offsets, ranks, side='right')
+    indices = np.array(self.bounds[:-1])[stripes] + ranks - (offsets - counts)[stripes]
+    used = np.unique(stripes)
+    for stripe in used:
+      self.locks[stripe].acquire()
+    try:
+      return [field[indices] for field in self.fields]
+    finally:
+      for stripe in used:
+        self.locks[stripe].release()
+
+
+def replay_fields(config):
+  """(shape, dtype) of the fields of the aux replay transitions: (s, s1, a), or their state indices with
+  compact_replay."""
+  if config.compact_replay:
+    return [((), np.int32)] * 4
+  observation = (tuple(config.input_size) + (config.history_size,), np.float32)
+  return [observation, observation, ((), np.int32)]
+
+
+def aux_replay_buffer(config, env, global_network=None, writer_id=0):
+  """Aux replay of a worker: a view of the SharedReplayBuffer of global_network when there is one (shared_replay),
+  otherwise a ReplayBuffer of its own. Transitions are stored as state indices with compact_replay."""
+  shared_buffer = getattr(global_network, "replay_buffer", None)
+  if shared_buffer is not None:
+    storage = shared_buffer.view(writer_id)
+  else:
+    storage = ReplayBuffer(config.memory_size)
+  if config.compact_replay:
+    return StateIndexReplayBuffer(storage, env)
+  return storage
+
+
+class StateIndexReplayBuffer():
+  """Replay of (s, s1, a) transitions of a GridWorld that stores in storage (a ReplayBuffer or SharedReplayBuffer) only
+  the agent cells of s and s1, the goal cell and the action, a few bytes per transition. Observations are a pure
+  function of the agent and goal cells, so minibatches are rendered back with env.get_goal_observations at sample time.
+  """
+
+  def __init__(self, storage, env):
+    self.storage = storage
+    self.env = env
+
+  def __len__(self):
+    return len(self.storage)
+
+  def append(self, s, s1, a):
+    indices, goal_indices = self.env.encode_observations([s, s1])
+    self.storage.append(np.int32(indices[0]), np.int32(indices[1]), np.int32(goal_indices[0]), np.int32(a))
+
+  def sample(self, batch_size):
+    states, next_states, goals, actions = self.storage.sample(batch_size)
+    observations = self.env.get_goal_observations(np.concatenate([states, next_states]), np.concatenate([goals, goals]))
+    return [observations[:batch_size], observations[batch_size:], actions]
@@ -1,34 +1,84 @@
+import threading
+
 import numpy as np
 
 class RingBuffer():
+  """Preallocated ring buffer of samples shared by several writer threads.
+
+  The rows are split into nb_stripes contiguous stripes, each with its own cursor and lock. A writer always appends to
+  the stripe of its writer_id, so appends are O(1), allocate nothing and writers with different ids never contend.
+  """
 
-  def __init__(self, shape):
+  def __init__(self, shape, nb_stripes=1, dtype='f'):
     self.buffer_size = shape[0]
-    self.data = np.zeros(shape, dtype='f')
-    self.index = -1
-    self.effective_size = 0
-    self.full = False
+    self.data = np.zeros(shape, dtype=dtype)
+    nb_stripes = max(1, min(nb_stripes, self.buffer_size))
+    self.bounds = np.linspace(0, self.buffer_size, nb_stripes + 1).astype(int).tolist()
+    self.cursors = [0] * nb_stripes
+    self.counts = [0] * nb_stripes
+    self.locks = [threading.Lock() for _ in range(nb_stripes)]
 
-  def append(self, x):
-    self.index += 1
-    x_index = self.index % self.buffer_size
-    self.data[x_index] = x
-    self.effective_size += 1
-    self.full = True if self.effective_size >= self.buffer_size else False
+  @property
+  def effective_size(self):
+    return sum(self.counts)
 
+  @property
+  def full(self):
+    return self.effective_size >= self.buffer_size
 
-  def get(self):
-    "Returns the first-in-first-out data in the ring buffer"
-    idx = (self.index + np.arange(self.buffer_size)) % self.buffer_size
-    return self.data[idx]
+  def append(self, x, writer_id=0):
+    stripe = writer_id % len(self.locks)
+    start, stripe_size = self.bounds[stripe], self.bounds[stripe + 1] - self.bounds[stripe]
+    with self.locks[stripe]:
+      self.data[start + self.cursors[stripe]] = x
+      self.cursors[stripe] = (self.cursors[stripe] + 1) % stripe_size
+      self.counts[stripe] = min(self.counts[stripe] + 1, stripe_size)
 
-if __name__ == '__main__':
-  ringbuff = RingBuffer((3, ))
-  for i in range(1, 40):
-    ringbuff.append(i)  # write
-    ringbuff.get()  # read
+  def snapshot(self):
+    """Copy of the whole buffer taken with every stripe locked, so no row is half written. Rows never written are
+    zero."""
+    return self._locked_copy()[0]
 
+  def _locked_copy(self):
+    for lock in self.locks:
+      lock.acquire()
+    try:
+      return self.data.copy(), list(self.cursors), list(self.counts)
+    finally:
+      for lock in self.locks:
+        lock.release()
 
+  def get(self):
+    "Returns the first-in-first-out data in the ring buffer, stripe after stripe"
+    data = self.snapshot()
+    stripes = [np.roll(data[start:end], -cursor, axis=0) if count == end - start else data[start:start + count]
+               for start, end, cursor, count in zip(self.bounds[:-1], self.bounds[1:], self.cursors, self.counts)]
+    return np.concatenate(stripes)
 
+  def save(self, path):
+    """Saves the buffer with every full stripe rotated so that its oldest row comes first, as load expects."""
+    data, cursors, counts = self._locked_copy()
+    for start, end, cursor, count in zip(self.bounds[:-1], self.bounds[1:], cursors, counts):
+      if count == end - start:
+        data[start:end] = np.roll(data[start:end], -cursor, axis=0)
+    np.save(path, data)
 
+  def load(self, path):
+    """Restores a buffer saved with save. The non-zero rows of each stripe are taken as written from its start, oldest
+    first, so the next append overwrites the oldest row."""
+    data = np.load(path)
+    if data.shape != self.data.shape:
+      raise ValueError("Cannot load a buffer of shape {} into one of shape {}".format(data.shape, self.data.shape))
+    written = np.any(data.reshape(len(data), -1) != 0, axis=1)
+    for stripe, lock in enumerate(self.locks):
+      start, end = self.bounds[stripe], self.bounds[stripe + 1]
+      with lock:
+        self.data[start:end] = data[start:end]
+        self.counts[stripe] = int(np.sum(written[start:end]))
+        self.cursors[stripe] = self.counts[stripe] % (end - start)
 
+if __name__ == '__main__':
+  ringbuff = RingBuffer((12, ), nb_stripes=3)
+  for i in range(1, 40):
+    ringbuff.append(i, writer_id=i % 3)  # write
+    ringbuff.get()  # read
@@ -0,0 +1,35 @@
+import numpy as np
+
+class RolloutBuffer():
+  """Columnar storage of the transitions of a rollout: one preallocated, typed array per field.
+
+  fields is a list of (name, dtype) pairs, a dtype of None taking the dtype of the first value appended. The arrays
+  start with capacity rows and double when a rollout outgrows them. Columns are read as views of the rows appended
+  since the last clear.
+  """
+
+  def __init__(self, capacity, fields):
+    self.capacity = int(capacity)
+    self.names = [name for name, _ in fields]
+    self.dtypes = [dtype for _, dtype in fields]
+    self.columns = None
+    self.size = 0
+
+  def __len__(self):
+    return self.size
+
+  def __getitem__(self, name):
+    return self.columns[self.names.index(name)][:self.size]
+
+  def append(self, *values):
+    if self.columns is None:
+      self.columns = [np.zeros((self.capacity,) + np.shape(x), dtype=dtype or np.asarray(x).dtype)
+                      for x, dtype in zip(values, self.dtypes)]
+    elif self.size == len(self.columns[0]):
+      self.columns = [np.concatenate([column, np.zeros_like(column)]) for column in self.columns]
+    for column, x in zip(self.columns, values):
+      column[self.size] = x
+    self.size += 1
+
+  def clear(self):
+    self.size = 0
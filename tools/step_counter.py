@@ -0,0 +1,32 @@
+import threading
+
+import tensorflow as tf
+
+class StepCounter():
+  """Counter kept in Python and added to a TF counter variable in batches.
+
+  add only bumps the pending count, and every sync_every counts the pending count is added to the variable with a
+  single assign_add. sync publishes what is pending at once (before a checkpoint, at shutdown) and may be called from
+  another thread than the one counting.
+  """
+
+  def __init__(self, variable, sync_every=1):
+    self.variable = variable
+    self.sync_every = max(1, int(sync_every or 1))
+    self.delta = tf.placeholder(variable.dtype.base_dtype, shape=[])
+    self.publish = variable.assign_add(self.delta)
+    self.pending = 0
+    self.lock = threading.Lock()
+
+  def add(self, sess, count=1):
+    with self.lock:
+      self.pending += count
+      if self.pending < self.sync_every:
+        return
+    self.sync(sess)
+
+  def sync(self, sess):
+    with self.lock:
+      if self.pending:
+        sess.run(self.publish, feed_dict={self.delta: self.pending})
+        self.pending = 0
@@ -0,0 +1,134 @@
+import collections
+import queue
+import threading
+import time
+
+import tensorflow as tf
+
+class SummarySink(threading.Thread):
+  """Process-wide TensorBoard writer: the acting threads queue their summaries and this thread writes them.
+
+  add_summary never blocks nor touches the disk: it puts (logdir, summary, step) on a bounded queue of queue_size
+  entries. The thread drains the queue in batches of up to batch_size, merges the summaries of a batch sharing a logdir
+  and step into one event and flushes its FileWriters every flush_secs. Under backpressure (queue full) scalar
+  summaries are aggregated into their mean per (logdir, tag), written at their last step with the next batch, and
+  other summaries (histograms, images) are dropped and counted under Summaries/Dropped.
+  """
+
+  def __init__(self, queue_size=1000, flush_secs=10, batch_size=256):
+    threading.Thread.__init__(self, name="summary_sink")
+    self.daemon = True
+    self.queue = queue.Queue(queue_size)
+    self.flush_secs = flush_secs
+    self.batch_size = batch_size
+    self.writers = {}
+    self.overflow_lock = threading.Lock()
+    self.overflow = collections.OrderedDict()
+    self.dropped = {}
+
+  def writer(self, logdir):
+    return SinkWriter(self, logdir)
+
+  def add_summary(self, logdir, summary, step):
+    try:
+      self.queue.put_nowait((logdir, summary, int(step)))
+    except queue.Full:
+      self._aggregate(logdir, summary, int(step))
+
+  def _aggregate(self, logdir, summary, step):
+    if not isinstance(summary, tf.Summary):
+      summary = tf.Summary.FromString(summary)
+    with self.overflow_lock:
+      if not all(value.HasField("simple_value") for value in summary.value):
+        nb_dropped, _, _ = self.dropped.get(logdir, (0, step, True))
+        self.dropped[logdir] = (nb_dropped + 1, step, False)
+        return
+      for value in summary.value:
+        total, count, _ = self.overflow.get((logdir, value.tag), (0., 0, step))
+        self.overflow[(logdir, value.tag)] = (total + value.simple_value, count + 1, step)
+
+  def _take_overflow(self):
+    """The aggregated scalars and the drop counts that changed, as (logdir, summary, step) entries."""
+    with self.overflow_lock:
+      overflow, self.overflow = self.overflow, collections.OrderedDict()
+      dropped = [(logdir, (nb_dropped, step)) for logdir, (nb_dropped, step, reported) in self.dropped.items()
+                 if not reported]
+      for logdir, (nb_dropped, step) in dropped:
+        self.dropped[logdir] = (nb_dropped, step, True)
+    entries = []
+    for (logdir, tag), (total, count, step) in overflow.items():
+      summary = tf.Summary()
+      summary.value.add(tag=tag, simple_value=total / count)
+      entries.append((logdir, summary, step))
+    for logdir, (nb_dropped, step) in dropped:
+      summary = tf.Summary()
+      summary.value.add(tag='Summaries/Dropped', simple_value=float(nb_dropped))
+      entries.append((logdir, summary, step))
+    return entries
+
+  def _next_batch(self, timeout):
+    """Up to batch_size queued entries, waiting at most timeout for the first one, and whether close was called."""
+    batch = []
+    try:
+      batch.append(self.queue.get(timeout=timeout))
+      while len(batch) < self.batch_size:
+        batch.append(self.queue.get_nowait())
+    except queue.Empty:
+      pass
+    closing = None in batch
+    return [entry for entry in batch if entry is not None], closing
+
+  def _write(self, entries):
+    merged = collections.OrderedDict()
+    for logdir, summary, step in entries:
+      if not isinstance(summary, tf.Summary):
+        summary = tf.Summary.FromString(summary)
+      merged.setdefault((logdir, step), tf.Summary()).MergeFrom(summary)
+    for (logdir, step), summary in merged.items():
+      if logdir not in self.writers:
+        self.writers[logdir] = tf.summary.FileWriter(logdir)
+      self.writers[logdir].add_summary(summary, step)
+
+  def flush(self):
+    for writer in self.writers.values():
+      writer.flush()
+
+  def run(self):
+    last_flush = time.time()
+    closing = False
+    while not closing:
+      batch, closing = self._next_batch(max(0., last_flush + self.flush_secs - time.time()))
+      self._write(batch + self._take_overflow())
+      if closing or time.time() >= last_flush + self.flush_secs:
+        self.flush()
+        last_flush = time.time()
+
+  def close(self):
+    """Writes and flushes everything queued so far, then stops the thread."""
+    self.queue.put(None)
+    self.join()
+    for writer in self.writers.values():
+      writer.close()
+
+
+class SinkWriter():
+  """FileWriter-like handle writing to logdir through a SummarySink. flush does nothing, the sink flushes on its own
+  schedule."""
+
+  def __init__(self, sink, logdir):
+    self.sink = sink
+    self.logdir = logdir
+
+  def add_summary(self, summary, global_step=None):
+    self.sink.add_summary(self.logdir, summary, global_step or 0)
+
+  def flush(self):
+    pass
+
+
+def summary_writer(logdir, global_network=None):
+  """A writer on the SummarySink of global_network when there is one, otherwise a FileWriter of its own."""
+  sink = getattr(global_network, "summary_sink", None)
+  if sink is not None:
+    return sink.writer(logdir)
+  return tf.summary.FileWriter(logdir)
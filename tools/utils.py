@@ -51,6 +51,51 @@ def update_target_graph_option(from_scope, to_scope):
   return op_holder
 
 
+def sync_group(variable):
+  """Group of parameters a variable is synced with: "sf", "option" or "aux" for all the others."""
+  if "sf" in variable.name:
+    return "sf"
+  if "option" in variable.name:
+    return "option"
+  return "aux"
+
+
+def update_local_graph(from_scope, to_scope, group):
+  """Single op copying the variables of a sync_group from from_scope into to_scope (see fused_assign)."""
+  from_vars = [v for v in tf.get_collection(tf.GraphKeys.TRAINABLE_VARIABLES, from_scope) if sync_group(v) == group]
+  to_vars = [v for v in tf.get_collection(tf.GraphKeys.TRAINABLE_VARIABLES, to_scope) if sync_group(v) == group]
+  return fused_assign(from_vars, to_vars)
+
+
+def fused_assign(from_vars, to_vars):
+  """Single op copying from_vars into to_vars: all of from_vars are read at once into one flat buffer, which is then
+  split back into the shapes of to_vars."""
+  if len(from_vars) != len(to_vars):
+    raise ValueError("Cannot copy {} variables into {}".format(len(from_vars), len(to_vars)))
+  for from_var, to_var in zip(from_vars, to_vars):
+    if from_var.shape.as_list() != to_var.shape.as_list():
+      raise ValueError("Cannot copy {} of shape {} into {} of shape {}".format(
+        from_var.name, from_var.shape, to_var.name, to_var.shape))
+  if not from_vars:
+    return tf.no_op()
+  flat = tf.concat([tf.reshape(v, [-1]) for v in from_vars], 0)
+  sizes = [int(np.prod(v.shape.as_list())) for v in to_vars]
+  return tf.group(*[to_var.assign(tf.reshape(part, tf.shape(to_var)))
+                    for to_var, part in zip(to_vars, tf.split(flat, sizes))])
+
+
+def evaluate_state_space(sess, network, env, tensors, batch_size=1024):
+  """Evaluates the given per-observation tensors of network on every free cell of env, in batched forward passes
+  over the cached free-cell observations. Returns one (nb_states, ...) matrix per tensor with zeros for the walls."""
+  free_states, observations = env.get_free_observations()
+  matrices = [np.zeros((env.nb_states,) + tuple(tensor.shape.as_list()[1:])) for tensor in tensors]
+  for start in range(0, len(free_states), batch_size):
+    results = sess.run(tensors, feed_dict={network.observation: observations[start:start + batch_size]})
+    for matrix, result in zip(matrices, results):
+      matrix[free_states[start:start + batch_size]] = result
+  return matrices
+
+
 def discount(x, gamma):
   # axis = len(x.shape) - 1
   return np.flip(lfilter([1], [1, -gamma], np.flip(x, 0), axis=0), axis=0)
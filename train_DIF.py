@@ -13,6 +13,9 @@ from env_wrappers import _create_environment
 import numpy as np
 import pickle
 from tools.ring_buffer import RingBuffer
+from tools.replay_buffer import SharedReplayBuffer, replay_fields
+from agents.eigenvector_service import EigenvectorService
+from tools.summary_sink import SummarySink
 
 def train(config, env_processes, logdir):
   tf.reset_default_graph()
@@ -30,6 +33,13 @@ def train(config, env_processes, logdir):
         action_size = envs[0].action_space.n
         nb_states = envs[0].nb_states
         global_network = config.network("global", config, action_size, nb_states)
+        if config.shared_replay:
+          # One aux replay memory of memory_size transitions for all the workers, with a stripe per worker
+          global_network.replay_buffer = SharedReplayBuffer(config.memory_size, replay_fields(config),
+                                                            config.num_agents)
+        if config.summary_sink:
+          # All the workers write their summaries through one background writer thread
+          global_network.summary_sink = SummarySink(config.summary_queue_size, config.summary_flush_secs)
 
         if FLAGS.task == "matrix":
           agent = config.dif_agent(envs[0], 0, global_step, config)
@@ -53,6 +63,8 @@ def train(config, env_processes, logdir):
         sess.run([tf.global_variables_initializer(), tf.local_variables_initializer()])
 
       coord = tf.train.Coordinator()
+      if config.summary_sink:
+        global_network.summary_sink.start()
 
       agent_threads = []
       if FLAGS.task == "matrix":
@@ -76,8 +88,16 @@ def train(config, env_processes, logdir):
           thread = threading.Thread(target=(lambda: agent.play(sess, coord, saver)))
           thread.start()
           agent_threads.append(thread)
+        if config.eigen and config.eigen_service:
+          service = EigenvectorService(sess, coord, global_network, _create_environment(config), global_step, config)
+          service.start()
+          agent_threads.append(service)
 
-      coord.join(agent_threads)
+      try:
+        coord.join(agent_threads)
+      finally:
+        if config.summary_sink:
+          global_network.summary_sink.close()
 
 def recreate_directory_structure(logdir):
   if not tf.gfile.Exists(logdir):
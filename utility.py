@@ -250,4 +250,8 @@ def huber_loss(x, delta=1.0):
     tf.abs(x) < delta,
     tf.square(x) * 0.5,
     delta * (tf.abs(x) - 0.5 * delta)
-  )
\ No newline at end of file
+  )
+
+def masked_mean(x, mask):
+  """Mean of x over the entries where mask is 1, and 0 when the mask is empty."""
+  return tf.reduce_sum(x * mask) / tf.maximum(tf.reduce_sum(mask), 1.)